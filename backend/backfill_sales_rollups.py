@@ -0,0 +1,64 @@
+"""Rebuild seller_sales_daily from the orders table.
+
+The orders trigger keeps the rollups current; run this once after creating the
+table, or to repair it: python backfill_sales_rollups.py [from_date] [to_date]
+
+Each month of the range is rebuilt by the rebuild_seller_sales_daily RPC in its own
+transaction, which replaces that month's rows using the trigger's arithmetic.
+Without dates the range covers every order and every existing rollup row.
+"""
+from supabase import create_client, Client
+from dotenv import load_dotenv
+from datetime import date, datetime, timedelta
+import logging
+import os
+import sys
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+def edge_day(table: str, column: str, desc: bool):
+    row = supabase.table(table).select(column).order(column, desc=desc).limit(1).execute().data
+    if not row or not row[0][column]:
+        return None
+    return datetime.fromisoformat(str(row[0][column]).replace("Z", "+00:00")).date()
+
+def default_range() -> tuple:
+    starts = [d for d in (edge_day("orders", "created_at", False), edge_day("seller_sales_daily", "day", False)) if d]
+    ends = [d for d in (edge_day("orders", "created_at", True), edge_day("seller_sales_daily", "day", True)) if d]
+    if not starts:
+        return None, None
+    return min(starts), max(ends)
+
+def month_windows(start: date, end: date):
+    while start <= end:
+        next_month = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        yield start, min(end, next_month - timedelta(days=1))
+        start = next_month
+
+def main():
+    if len(sys.argv) > 2:
+        start, end = date.fromisoformat(sys.argv[1]), date.fromisoformat(sys.argv[2])
+    else:
+        start, end = default_range()
+        if start is None:
+            logger.info("No orders or rollups to rebuild")
+            return
+    written = 0
+    for window_start, window_end in month_windows(start, end):
+        rows = supabase.rpc("rebuild_seller_sales_daily", {
+            "p_from": window_start.isoformat(),
+            "p_to": window_end.isoformat()
+        }).execute().data
+        written += rows or 0
+        logger.info(f"Rebuilt {window_start} to {window_end}: {rows} rows")
+    logger.info(f"Wrote {written} seller_sales_daily rows for {start} to {end}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Store coordinates on wanted products saved before they were geocoded on insert.
+
+GET /farmer/wanted-products?near= filters on the stored latitude/longitude, so rows
+without them are never found by a radius search. Run once after deploying:
+python backfill_wanted_coordinates.py
+
+Each request is geocoded from its delivery location, falling back to the buyer's
+location, and a page of results is written with one set_wanted_product_coordinates call.
+"""
+from supabase import create_client, Client
+from dotenv import load_dotenv
+import logging
+import os
+
+import geo_utils
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+PAGE_SIZE = 500
+
+def locate(row: dict):
+    return geo_utils.geocode(row.get("deliveryLocation")) or geo_utils.geocode((row.get("buyers") or {}).get("location"))
+
+def main():
+    scanned = 0
+    written = 0
+    last_id = None
+    while True:
+        query = supabase.table("user_wanted_products").select("id, deliveryLocation, buyers(location)").is_("latitude", "null")
+        if last_id:
+            query = query.gt("id", last_id)
+        page = query.order("id").limit(PAGE_SIZE).execute().data
+        points = []
+        for row in page:
+            point = locate(row)
+            if point:
+                points.append({"id": row["id"], "latitude": point[0], "longitude": point[1]})
+        if points:
+            written += supabase.rpc("set_wanted_product_coordinates", {"p_points": points}).execute().data or 0
+        scanned += len(page)
+        if len(page) < PAGE_SIZE:
+            break
+        last_id = page[-1]["id"]
+    logger.info(f"Scanned {scanned} wanted products without coordinates, stored {written}")
+
+if __name__ == "__main__":
+    main()
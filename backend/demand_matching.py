@@ -0,0 +1,177 @@
+import heapq
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+
+from geo_utils import GeoGridIndex
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Score contributed by one matching term, by where the farmer's term came from
+LISTING_WEIGHT = 2.0
+CROP_WEIGHT = 1.0
+# Farmers without a known location still match local requests, at reduced score
+UNLOCATED_PENALTY = 0.5
+# Listing words that say nothing about the crop
+STOPWORDS = {"fresh", "organic", "natural", "premium", "quality", "best", "local", "farm", "the", "and", "of", "for", "kg", "per"}
+
+def terms(text: Optional[str]) -> set:
+    """Lowercase word stems, so "Tomatoes, onion" and "tomato" share terms."""
+    stems = set()
+    for word in re.findall(r"[a-z]+", (text or "").lower()):
+        if len(word) > 4 and word.endswith("oes"):
+            word = word[:-2]
+        elif len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        if len(word) > 1 and word not in STOPWORDS:
+            stems.add(word)
+    return stems
+
+class DemandMatcher:
+    """Inverted index from crop and product terms to farmers.
+
+    Farmers are indexed by their main crops and by the names of their in-stock
+    product listings; locations come from a shared GeoGridIndex keyed by farmer id.
+    match() only visits the posting lists of the request's terms. Listing
+    categories (seeds, tools, ...) are not crop categories, so they are not indexed.
+    """
+
+    def __init__(self, locations: Optional[GeoGridIndex] = None):
+        self.locations = locations if locations is not None else GeoGridIndex()
+        self.postings: Dict[str, Dict[str, float]] = {}
+        self.farmer_crops: Dict[str, set] = {}
+        self.listings: Dict[str, Tuple[str, set]] = {}
+        # Out-of-stock listings, kept so a restock can reactivate them without the name
+        self.inactive: Dict[str, Tuple[str, set]] = {}
+        self.listing_refs: Dict[Tuple[str, str], int] = {}
+
+    def _rebuild_farmer(self, farmer_id: str, affected: set):
+        # A farmer's weight for a term is the best of its crop and listing sources
+        for term in affected:
+            weight = 0.0
+            if term in self.farmer_crops.get(farmer_id, ()):
+                weight = CROP_WEIGHT
+            if self.listing_refs.get((term, farmer_id)):
+                weight = LISTING_WEIGHT
+            farmers = self.postings.get(term)
+            if weight:
+                self.postings.setdefault(term, {})[farmer_id] = weight
+            elif farmers is not None:
+                farmers.pop(farmer_id, None)
+                if not farmers:
+                    del self.postings[term]
+
+    def set_farmer_crops(self, farmer_id: str, main_crops: Optional[str]):
+        old = self.farmer_crops.pop(farmer_id, set())
+        new = terms(main_crops)
+        if new:
+            self.farmer_crops[farmer_id] = new
+        self._rebuild_farmer(farmer_id, old | new)
+
+    def _activate(self, product_id: str, listing: Tuple[str, set]):
+        farmer_id, listing_terms = listing
+        self.listings[product_id] = listing
+        for term in listing_terms:
+            self.listing_refs[(term, farmer_id)] = self.listing_refs.get((term, farmer_id), 0) + 1
+        self._rebuild_farmer(farmer_id, listing_terms)
+
+    def _release(self, listing: Tuple[str, set]):
+        farmer_id, listing_terms = listing
+        for term in listing_terms:
+            refs = self.listing_refs.get((term, farmer_id), 0) - 1
+            if refs > 0:
+                self.listing_refs[(term, farmer_id)] = refs
+            else:
+                self.listing_refs.pop((term, farmer_id), None)
+        self._rebuild_farmer(farmer_id, listing_terms)
+
+    def add_listing(self, product_id: str, farmer_id: str, name: Optional[str], in_stock: bool = True):
+        self.remove_listing(product_id)
+        listing = (farmer_id, terms(name))
+        if in_stock:
+            self._activate(product_id, listing)
+        else:
+            self.inactive[product_id] = listing
+
+    def remove_listing(self, product_id: str):
+        self.inactive.pop(product_id, None)
+        listing = self.listings.pop(product_id, None)
+        if listing is not None:
+            self._release(listing)
+
+    def set_listing_stock(self, product_id: str, in_stock: bool):
+        """Only in-stock listings match; stock changes move a listing in or out."""
+        if in_stock and product_id in self.inactive:
+            self._activate(product_id, self.inactive.pop(product_id))
+        elif not in_stock and product_id in self.listings:
+            listing = self.listings.pop(product_id)
+            self._release(listing)
+            self.inactive[product_id] = listing
+
+    def match(
+        self,
+        product_name: str,
+        point: Optional[Tuple[float, float]] = None,
+        radius_km: float = 150.0,
+        k: int = 20
+    ) -> List[Tuple[str, float, Optional[float]]]:
+        """Return up to k (farmer_id, score, distance_km) tuples, best first.
+
+        With a point, farmers farther than radius_km are dropped and nearer
+        farmers score higher; farmers with no location are kept at a penalty.
+        """
+        query_terms = terms(product_name)
+        scores: Dict[str, float] = {}
+        for term in query_terms:
+            for farmer_id, weight in self.postings.get(term, {}).items():
+                scores[farmer_id] = scores.get(farmer_id, 0.0) + weight
+        if not scores:
+            return []
+        distances: Dict[str, float] = {}
+        if point:
+            distances = dict(self.locations.query(point[0], point[1], radius_km))
+        ranked = []
+        for farmer_id, score in scores.items():
+            distance = distances.get(farmer_id)
+            if point:
+                if distance is not None:
+                    score *= 1.0 / (1.0 + distance / radius_km)
+                elif farmer_id in self.locations.points:
+                    continue
+                else:
+                    score *= UNLOCATED_PENALTY
+            ranked.append((farmer_id, round(score, 4), None if distance is None else round(distance, 1)))
+        return heapq.nlargest(k, ranked, key=lambda m: m[1])
+
+if __name__ == "__main__":
+    # Matching benchmark: python demand_matching.py [farmers] [listings_per_farmer] [queries]
+    import random
+    import sys
+    import time
+
+    n_farmers = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    per_farmer = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    n_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    rng = random.Random(42)
+    crops = ["tomato", "onion", "potato", "rice", "wheat", "banana", "mango", "chilli", "okra", "brinjal",
+             "cabbage", "carrot", "turmeric", "ginger", "coconut", "groundnut", "maize", "cotton", "grape", "garlic"]
+    def random_point():
+        return (rng.uniform(8.0, 35.0), rng.uniform(68.0, 97.0))
+
+    matcher = DemandMatcher()
+    start = time.perf_counter()
+    for f in range(n_farmers):
+        farmer_id = f"farmer-{f}"
+        matcher.locations.add(farmer_id, *random_point())
+        matcher.set_farmer_crops(farmer_id, ", ".join(rng.sample(crops, 3)))
+        for p in range(per_farmer):
+            matcher.add_listing(f"{farmer_id}-{p}", farmer_id, f"Fresh {rng.choice(crops)}es", rng.random() > 0.1)
+    print(f"Indexed {n_farmers} farmers and {n_farmers * per_farmer} listings in {time.perf_counter() - start:.2f}s")
+
+    queries = [(rng.choice(crops), random_point()) for _ in range(n_queries)]
+    start = time.perf_counter()
+    found = sum(len(matcher.match(name, point)) for name, point in queries)
+    print(f"Match: {(time.perf_counter() - start) * 1000 / n_queries:.3f} ms/query, {found / n_queries:.1f} farmers/query")
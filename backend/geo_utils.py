@@ -0,0 +1,156 @@
+import csv
+import logging
+import math
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PLACE_CENTROIDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "place_centroids.csv")
+EARTH_RADIUS_KM = 6371.0
+
+_place_patterns: List[Tuple[re.Pattern, Tuple[float, float]]] = []
+_pin_prefixes: Dict[str, Tuple[float, float]] = {}
+_places: List[Tuple[str, float, float]] = []
+
+def _load_places():
+    if _place_patterns:
+        return
+    names = []
+    with open(PLACE_CENTROIDS_PATH, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            point = (float(row["lat"]), float(row["lon"]))
+            _places.append((row["name"], *point))
+            for name in [row["name"]] + [a for a in row["aliases"].split("|") if a]:
+                names.append((name.lower(), point))
+            if row["pin_prefix"]:
+                _pin_prefixes.setdefault(row["pin_prefix"], point)
+    # Longest names first so "new delhi" wins over "delhi"
+    for name, point in sorted(names, key=lambda n: -len(n[0])):
+        _place_patterns.append((re.compile(rf"\b{re.escape(name)}\b"), point))
+    logger.info(f"Loaded {len(names)} place names and {len(_pin_prefixes)} PIN prefixes")
+
+@lru_cache(maxsize=10000)
+def geocode(text: Optional[str]) -> Optional[Tuple[float, float]]:
+    """Resolve free-text location to (lat, lon) using the bundled centroid table.
+
+    Accepts "lat,lon", text containing a 6-digit PIN code, or a known place name.
+    """
+    if not text:
+        return None
+    literal = re.fullmatch(r"\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*", text)
+    if literal:
+        lat, lon = float(literal.group(1)), float(literal.group(2))
+        if -90 <= lat <= 90 and -180 <= lon <= 180:
+            return (lat, lon)
+    _load_places()
+    pin = re.search(r"\b(\d{3})\s?\d{3}\b", text)
+    if pin and pin.group(1) in _pin_prefixes:
+        return _pin_prefixes[pin.group(1)]
+    lowered = text.lower()
+    for pattern, point in _place_patterns:
+        if pattern.search(lowered):
+            return point
+    return None
+
+@lru_cache(maxsize=10000)
+def nearest_place(lat: float, lon: float) -> Optional[str]:
+    """Name of the closest place in the centroid table, for labelling coordinates."""
+    _load_places()
+    if not _places:
+        return None
+    return min(_places, key=lambda p: haversine_km(lat, lon, p[1], p[2]))[0]
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def bounding_box(lat: float, lon: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """(min_lat, max_lat, min_lon, max_lon) of a box containing the radius around a point."""
+    dlat = radius_km / 111.0
+    dlon = radius_km / (111.32 * max(math.cos(math.radians(lat)), 0.01))
+    return (lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+
+class GeoGridIndex:
+    """Fixed-size lat/lon grid; a radius query only visits the cells its bounding box overlaps."""
+
+    def __init__(self, cell_deg: float = 0.25):
+        self.cell_deg = cell_deg
+        self.cells: Dict[Tuple[int, int], set] = {}
+        self.points: Dict[str, Tuple[float, float]] = {}
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def add(self, key: str, lat: float, lon: float):
+        self.remove(key)
+        self.points[key] = (lat, lon)
+        self.cells.setdefault(self._cell(lat, lon), set()).add(key)
+
+    def remove(self, key: str):
+        point = self.points.pop(key, None)
+        if point is None:
+            return
+        cell = self._cell(*point)
+        members = self.cells.get(cell)
+        if members:
+            members.discard(key)
+            if not members:
+                del self.cells[cell]
+
+    def __len__(self):
+        return len(self.points)
+
+    def query(self, lat: float, lon: float, radius_km: float) -> List[Tuple[str, float]]:
+        """Return (key, distance_km) pairs within radius_km, nearest first."""
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+        min_row, min_col = self._cell(min_lat, min_lon)
+        max_row, max_col = self._cell(max_lat, max_lon)
+        matches = []
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                for key in self.cells.get((row, col), ()):
+                    point_lat, point_lon = self.points[key]
+                    distance = haversine_km(lat, lon, point_lat, point_lon)
+                    if distance <= radius_km:
+                        matches.append((key, distance))
+        matches.sort(key=lambda m: m[1])
+        return matches
+
+if __name__ == "__main__":
+    # Radius query benchmark: python geo_utils.py [points] [queries] [radius_km]
+    import random
+    import sys
+    import time
+
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    radius = float(sys.argv[3]) if len(sys.argv) > 3 else 50.0
+    rng = random.Random(42)
+
+    def random_point():
+        return (rng.uniform(8.0, 35.0), rng.uniform(68.0, 97.0))
+
+    index = GeoGridIndex()
+    start = time.perf_counter()
+    for i in range(n_points):
+        index.add(str(i), *random_point())
+    print(f"Indexed {n_points} points in {time.perf_counter() - start:.2f}s")
+
+    queries = [random_point() for _ in range(n_queries)]
+    start = time.perf_counter()
+    found = sum(len(index.query(lat, lon, radius)) for lat, lon in queries)
+    grid_ms = (time.perf_counter() - start) * 1000 / n_queries
+    print(f"Grid: {grid_ms:.3f} ms/query, {found / n_queries:.1f} matches/query")
+
+    sample = queries[:max(1, n_queries // 20)]
+    start = time.perf_counter()
+    for lat, lon in sample:
+        [k for k, (plat, plon) in index.points.items() if haversine_km(lat, lon, plat, plon) <= radius]
+    scan_ms = (time.perf_counter() - start) * 1000 / len(sample)
+    print(f"Full scan: {scan_ms:.3f} ms/query ({scan_ms / grid_ms:.0f}x slower)")
@@ -0,0 +1,90 @@
+from PIL import Image, ImageOps
+import io
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Longest edge in pixels for each derivative
+DERIVATIVE_SIZES = {
+    "thumb": 200,
+    "card": 480,
+    "full": 1280
+}
+
+DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpg": ("JPEG", "image/jpeg", {"quality": 85, "optimize": True, "progressive": True})
+}
+
+def build_derivatives(image_content: bytes) -> dict:
+    """Resize an uploaded image into every derivative size and format.
+
+    Runs in a worker process, so it only takes and returns plain bytes.
+    Returns {size: {ext: (content_type, bytes)}}.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_content))
+        image.seek(0)
+        image = ImageOps.exif_transpose(image)
+    except Exception:
+        logger.error("Invalid image format")
+        raise ValueError("Invalid image format")
+
+    if image.mode != "RGB":
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        rgba = image.convert("RGBA")
+        background.paste(rgba, mask=rgba.split()[-1])
+        image = background
+
+    derivatives = {}
+    # Largest first so each smaller size is resampled from the previous one
+    for size_name, max_edge in sorted(DERIVATIVE_SIZES.items(), key=lambda s: -s[1]):
+        image = image.copy()
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        derivatives[size_name] = {}
+        for ext, (pil_format, content_type, options) in DERIVATIVE_FORMATS.items():
+            buffer = io.BytesIO()
+            image.save(buffer, pil_format, **options)
+            derivatives[size_name][ext] = (content_type, buffer.getvalue())
+    return derivatives
+
+def derivative_path(base_path: str, size_name: str, ext: str) -> str:
+    return f"{base_path}_{size_name}.{ext}"
+
+def thumbnail_url(image_url: str | None) -> str | None:
+    """Map a stored full-size derivative URL to its WebP thumbnail."""
+    if not image_url or "_full." not in image_url:
+        return image_url
+    base, _ = image_url.rsplit("_full.", 1)
+    return f"{base}_thumb.webp"
+
+if __name__ == "__main__":
+    # Conversion throughput benchmark: python image_utils.py [image_path] [rounds]
+    import os
+    import sys
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            sample = f.read()
+    else:
+        buffer = io.BytesIO()
+        Image.effect_mandelbrot((3000, 2000), (-2.0, -1.0, 1.0, 1.0), 100).convert("RGB").save(buffer, "JPEG", quality=90)
+        sample = buffer.getvalue()
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        build_derivatives(sample)
+    single = rounds / (time.perf_counter() - start)
+    print(f"1 core: {single:.2f} images/s")
+
+    workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(build_derivatives, [sample] * workers))
+        start = time.perf_counter()
+        list(pool.map(build_derivatives, [sample] * rounds * workers))
+        pooled = rounds * workers / (time.perf_counter() - start)
+    print(f"{workers} cores: {pooled:.2f} images/s ({pooled / workers:.2f} images/s per core)")
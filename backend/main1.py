@@ -1,4 +1,6 @@
-from fastapi import FastAPI, HTTPException, Depends, Header, File, UploadFile
+from fastapi import FastAPI, HTTPException, Depends, Header, File, UploadFile, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
 from supabase import create_client, Client
 from fastapi.middleware.cors import CORSMiddleware
@@ -9,13 +11,26 @@ import string
 import smtplib
 from email.mime.text import MIMEText
 import logging
+import re
 import uuid
+import base64
+import hashlib
+import json
+import csv
+import time
+import asyncio
+from bisect import bisect_left
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from fastapi.security import OAuth2PasswordBearer
-from typing import Dict, Optional, List
-from datetime import datetime, date
+from typing import Awaitable, Callable, Dict, Optional, List
+from datetime import datetime, date, timedelta, timezone
 from bs4 import BeautifulSoup
 import requests
 import module1
+import image_utils
+import geo_utils
+import demand_matching
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,6 +45,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Total-Count", "X-Next-Cursor", "X-Error-Code"],
 )
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -116,6 +132,16 @@ class Product(BaseModel):
     description: str | None = None
     image: str | None = None
 
+class ProductPatch(BaseModel):
+    id: str
+    name: str | None = None
+    category: str | None = None
+    quantity: float | None = None
+    unit: str | None = None
+    price: float | None = None
+    description: str | None = None
+    image: str | None = None
+
 class OrderItem(BaseModel):
     id: str
     name: str
@@ -168,13 +194,456 @@ async def get_session(x_session_id: str = Header(...)):
         raise HTTPException(status_code=401, detail="Invalid or missing session ID")
     return sessions[x_session_id]
 
+# EventSource cannot send custom headers, and a session ID in the URL would end up in
+# access logs. Streams are opened with ?token= instead: a single-use token from
+# POST /events/token that expires after STREAM_TOKEN_TTL seconds.
+STREAM_TOKEN_TTL = int(os.getenv("STREAM_TOKEN_TTL", 60))
+
+stream_tokens: Dict[str, dict] = {}
+stream_token_expiry: deque = deque()
+
+def issue_stream_token(session_id: str) -> str:
+    now = time.time()
+    while stream_token_expiry and stream_token_expiry[0][0] < now:
+        stream_tokens.pop(stream_token_expiry.popleft()[1], None)
+    token = base64.urlsafe_b64encode(os.urandom(24)).decode().rstrip("=")
+    stream_tokens[token] = {"session_id": session_id, "expires": now + STREAM_TOKEN_TTL}
+    stream_token_expiry.append((now + STREAM_TOKEN_TTL, token))
+    return token
+
+async def get_stream_session(x_session_id: Optional[str] = Header(None), token: Optional[str] = None):
+    sid = x_session_id
+    if not sid and token:
+        issued = stream_tokens.pop(token, None)
+        if issued and issued["expires"] >= time.time():
+            sid = issued["session_id"]
+    if not sid or sid not in sessions:
+        raise HTTPException(status_code=401, detail="Invalid or missing session ID")
+    return sessions[sid]
+
+def parse_fields(fields: Optional[str], allowed: List[str]) -> str:
+    """Turn a comma-separated `fields=` parameter into a PostgREST select list."""
+    if not fields:
+        return "*"
+    requested = list(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    invalid = [f for f in requested if f not in allowed]
+    if invalid or not requested:
+        raise HTTPException(status_code=400, detail=f"Invalid fields: {invalid}. Allowed: {allowed}")
+    return ",".join(requested)
+
+def mutate_or_raise(
+    query,
+    table: str,
+    record_id: str,
+    not_found_detail: str,
+    forbidden_detail: Optional[str] = None,
+    on_miss: Optional[Callable[[dict], None]] = None
+) -> List[dict]:
+    """Execute a filtered update/delete/upsert and return the affected rows.
+
+    Ownership and state checks belong in the query's filters, so the happy path
+    is one round trip. When nothing matched, the row is read once to choose
+    between 404, `on_miss` (for state-specific errors) and 403.
+    """
+    response = query.execute()
+    if response.data:
+        return response.data
+    existing = supabase.table(table).select("*").eq("id", record_id).execute()
+    if not existing.data:
+        raise HTTPException(status_code=404, detail=not_found_detail)
+    if on_miss:
+        on_miss(existing.data[0])
+    raise HTTPException(status_code=403, detail=forbidden_detail or not_found_detail)
+
+# In-memory geo index of sellers keyed by user_id (from farmer_details.address).
+# Wanted products are filtered by their stored coordinates in the database instead;
+# backfill_wanted_coordinates.py fills them in for requests saved before they existed.
+seller_geo_index = geo_utils.GeoGridIndex()
+geo_indexes_loaded = False
+# near= product searches cover at most this many of the nearest sellers
+GEO_MAX_SELLERS = int(os.getenv("GEO_MAX_SELLERS", 200))
+
+def row_point(row: dict, *locations: Optional[str]) -> Optional[tuple]:
+    if row.get("latitude") is not None and row.get("longitude") is not None:
+        return (row["latitude"], row["longitude"])
+    for location in locations:
+        point = geo_utils.geocode(location)
+        if point:
+            return point
+    return None
+
+def geo_index_seller(user_id: str, address: Optional[str], point: Optional[tuple] = None):
+    if not geo_indexes_loaded:
+        return
+    point = point or geo_utils.geocode(address)
+    if point:
+        seller_geo_index.add(user_id, *point)
+    else:
+        seller_geo_index.remove(user_id)
+    # Cached near= product listings depend on every seller's location
+    catalog_versions["geo"] = catalog_versions.get("geo", 0) + 1
+
+def ensure_geo_loaded():
+    global geo_indexes_loaded
+    if geo_indexes_loaded:
+        return
+    page_size = 1000
+    geo_indexes_loaded = True
+    try:
+        offset = 0
+        while True:
+            page = supabase.table("farmer_details").select("*").range(offset, offset + page_size - 1).execute()
+            for row in page.data:
+                point = row_point(row, row.get("address"))
+                if point:
+                    seller_geo_index.add(row["user_id"], *point)
+            if len(page.data) < page_size:
+                break
+            offset += page_size
+    except Exception:
+        geo_indexes_loaded = False
+        raise
+    logger.info(f"Loaded geo index: {len(seller_geo_index)} sellers")
+
+# Demand matching: farmers indexed by main crops and in-stock product listings, sharing
+# the seller geo index, so a new buyer request is routed to its top-K farmers on write.
+MATCH_TOP_K = int(os.getenv("MATCH_TOP_K", 20))
+MATCH_RADIUS_KM = float(os.getenv("MATCH_RADIUS_KM", 150))
+
+demand_matcher = demand_matching.DemandMatcher(seller_geo_index)
+matcher_loaded = False
+
+def match_index_listing(row: dict):
+    if matcher_loaded:
+        demand_matcher.add_listing(row["id"], row["seller_id"], row.get("name"), (row.get("quantity") or 0) > 0)
+
+def match_set_stock(product_id: str, quantity: float):
+    if matcher_loaded:
+        demand_matcher.set_listing_stock(product_id, quantity > 0)
+
+def match_remove_listing(product_id: str):
+    if matcher_loaded:
+        demand_matcher.remove_listing(product_id)
+
+def match_set_farmer(user_id: str, main_crops: Optional[str]):
+    if matcher_loaded:
+        demand_matcher.set_farmer_crops(user_id, main_crops)
+
+def ensure_matcher_loaded():
+    global matcher_loaded
+    if matcher_loaded:
+        return
+    ensure_geo_loaded()
+    page_size = 1000
+    matcher_loaded = True
+    try:
+        offset = 0
+        while True:
+            page = supabase.table("farmer_details").select("user_id, main_crops").range(offset, offset + page_size - 1).execute()
+            for row in page.data:
+                match_set_farmer(row["user_id"], row.get("main_crops"))
+            if len(page.data) < page_size:
+                break
+            offset += page_size
+        offset = 0
+        while True:
+            page = supabase.table("products").select("id, seller_id, name, quantity").range(offset, offset + page_size - 1).execute()
+            for row in page.data:
+                match_index_listing(row)
+            if len(page.data) < page_size:
+                break
+            offset += page_size
+    except Exception:
+        matcher_loaded = False
+        demand_matcher.__init__(seller_geo_index)
+        raise
+    logger.info(f"Loaded demand matcher: {len(demand_matcher.farmer_crops)} farmers with crops, {len(demand_matcher.listings)} listings")
+
+def write_wanted_routes(row: dict, matches: list) -> List[dict]:
+    """Write feed entries and notifications for the matched farmers; runs in a worker thread."""
+    now = datetime.utcnow().isoformat()
+    supabase.table("farmer_feed").upsert([{
+        "farmer_id": farmer_id,
+        "wanted_product_id": row["id"],
+        "score": score,
+        "distance_km": distance,
+        "created_at": now
+    } for farmer_id, score, distance in matches], on_conflict="farmer_id,wanted_product_id").execute()
+    notifications = supabase.table("notifications").insert([{
+        "id": str(uuid.uuid4()),
+        "farmer_id": farmer_id,
+        "wanted_product_id": row["id"],
+        "status": "new",
+        "type": "request_match",
+        "created_at": now,
+        "updated_at": now
+    } for farmer_id, _, _ in matches]).execute()
+    return notifications.data
+
+async def route_wanted_product(row: dict):
+    """Route a saved request to its best matching farmers, after the response is sent.
+
+    Matching and event publishing stay on the event loop, which owns the matcher and
+    the event queues; the writes and the notification rendering query run in a worker
+    thread. Routing is best effort: the request stays visible in the full feed if it
+    fails, or if the matcher did not load at startup.
+    """
+    if not matcher_loaded:
+        logger.warning(f"Demand matcher not loaded, not routing wanted product {row['id']}")
+        return
+    try:
+        loop = asyncio.get_running_loop()
+        point = row_point(row)
+        matches = [m for m in demand_matcher.match(row["product_name"], point, MATCH_RADIUS_KM, MATCH_TOP_K) if m[0] != row["user_id"]]
+        if matches:
+            notifications = await loop.run_in_executor(None, write_wanted_routes, row, matches)
+            rendered = await loop.run_in_executor(None, assemble_notifications, notifications)
+            notifications_created(notifications, rendered)
+        logger.info(f"Routed wanted product {row['id']} to {len(matches)} farmers")
+    except Exception as e:
+        logger.error(f"Error routing wanted product {row['id']}: {str(e)}")
+
+# Running routing tasks, referenced so they are not garbage collected mid-flight
+routing_tasks: set = set()
+
+def schedule_wanted_routing(row: dict):
+    task = asyncio.create_task(route_wanted_product(row))
+    routing_tasks.add(task)
+    task.add_done_callback(routing_tasks.discard)
+
+def parse_near(near: Optional[str], radius_km: float) -> Optional[tuple]:
+    if not near:
+        return None
+    try:
+        lat, lon = (float(v) for v in near.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="near must be 'lat,lon'")
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise HTTPException(status_code=400, detail="near is out of range")
+    if radius_km <= 0 or radius_km > 1000:
+        raise HTTPException(status_code=400, detail="radius_km must be between 0 and 1000")
+    return (lat, lon)
+
+# Server-sent event hub: one bounded queue per open connection, grouped by
+# channel and user, so each connection only receives events addressed to its user.
+# The last EVENT_HISTORY_SIZE events per channel and user are kept so a reconnecting
+# client can resume from its Last-Event-ID. Ids are "<process epoch>.<sequence>".
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 100))
+EVENT_HEARTBEAT_SECONDS = int(os.getenv("EVENT_HEARTBEAT_SECONDS", 15))
+EVENT_HISTORY_SIZE = int(os.getenv("EVENT_HISTORY_SIZE", 100))
+EVENT_HISTORY_MAX_USERS = int(os.getenv("EVENT_HISTORY_MAX_USERS", 10000))
+EVENT_EPOCH = str(int(time.time()))
+
+event_subscribers: Dict[str, Dict[str, set]] = {}
+event_history: Dict[tuple, dict] = {}
+event_sequence = 0
+# Highest sequence lost with a whole user history evicted from event_history
+event_history_floor = 0
+
+def publish_event(channel: str, user_ids, event: dict):
+    global event_sequence, event_history_floor
+    payload = json.dumps(jsonable_encoder(event))
+    for user_id in set(user_ids):
+        event_sequence += 1
+        entry = (event_sequence, payload)
+        history = event_history.pop((channel, user_id), None)
+        if history is None:
+            history = {"entries": deque(maxlen=EVENT_HISTORY_SIZE), "evicted": 0}
+            while len(event_history) >= EVENT_HISTORY_MAX_USERS:
+                dropped = event_history.pop(next(iter(event_history)))
+                event_history_floor = max(event_history_floor, dropped["entries"][-1][0])
+        if len(history["entries"]) == EVENT_HISTORY_SIZE:
+            history["evicted"] = history["entries"][0][0]
+        history["entries"].append(entry)
+        event_history[(channel, user_id)] = history
+        for queue in event_subscribers.get(channel, {}).get(user_id, ()):
+            if queue.full():
+                # Slow consumer: drop its oldest event rather than grow without bound
+                queue.get_nowait()
+            queue.put_nowait(entry)
+
+def events_since(channel: str, user_id: str, last_event_id: Optional[str]) -> Optional[list]:
+    """Buffered events after last_event_id, or None when some were missed and the client must refetch."""
+    if not last_event_id:
+        return []
+    epoch, _, sequence = last_event_id.partition(".")
+    if epoch != EVENT_EPOCH or not sequence.isdigit():
+        return None
+    sequence = int(sequence)
+    history = event_history.get((channel, user_id))
+    if history is None:
+        return None if sequence < event_history_floor else []
+    if sequence < history["evicted"]:
+        return None
+    return [entry for entry in history["entries"] if entry[0] > sequence]
+
+async def event_stream(request: Request, channel: str, user_id: str, last_event_id: Optional[str] = None):
+    queue: asyncio.Queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+    event_subscribers.setdefault(channel, {}).setdefault(user_id, set()).add(queue)
+    try:
+        yield "retry: 5000\n\n"
+        last_sent = 0
+        missed = events_since(channel, user_id, last_event_id)
+        if missed is None:
+            # The buffer no longer covers the gap; tell the client to reload its state
+            yield f"id: {EVENT_EPOCH}.{event_sequence}\nevent: reset\ndata: {{}}\n\n"
+            last_sent = event_sequence
+        else:
+            for sequence, payload in missed:
+                yield f"id: {EVENT_EPOCH}.{sequence}\nevent: {channel}\ndata: {payload}\n\n"
+                last_sent = sequence
+        while not await request.is_disconnected():
+            try:
+                sequence, payload = await asyncio.wait_for(queue.get(), timeout=EVENT_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if sequence <= last_sent:
+                continue
+            yield f"id: {EVENT_EPOCH}.{sequence}\nevent: {channel}\ndata: {payload}\n\n"
+            last_sent = sequence
+    finally:
+        user_queues = event_subscribers[channel][user_id]
+        user_queues.discard(queue)
+        if not user_queues:
+            del event_subscribers[channel][user_id]
+
+def event_stream_response(request: Request, channel: str, user_id: str) -> StreamingResponse:
+    # Browsers send Last-Event-ID on reconnect; ?last_event_id= covers a fresh EventSource
+    last_event_id = request.headers.get("last-event-id") or request.query_params.get("last_event_id")
+    return StreamingResponse(
+        event_stream(request, channel, user_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def publish_order_event(order: dict, event_type: str):
+    recipients = [order["buyer_id"]] + [p.get("seller_id") for p in order.get("products", []) if p.get("seller_id")]
+    publish_event("order", recipients, {
+        "type": event_type,
+        "order_id": order["id"],
+        "status": order.get("status"),
+        "pickup_time": order.get("pickup_time"),
+        "tracking_link": order.get("tracking_link"),
+        "updated_at": order.get("updated_at")
+    })
+
+# Idempotency-Key support for non-idempotent POSTs. The first successful result is
+# kept for IDEMPOTENCY_TTL seconds and replayed to retries; a retry that arrives while
+# the first attempt is still running waits for it instead of running the handler again.
+# Records live in this process only, so retries are deduplicated per worker.
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 24 * 3600))
+
+idempotency_records: Dict[tuple, dict] = {}
+# (expires, record key) in insertion order; with a fixed TTL that is also expiry order
+idempotency_expiry: deque = deque()
+
+def purge_idempotency_records():
+    now = time.time()
+    while idempotency_expiry and idempotency_expiry[0][0] < now:
+        expires, record_key = idempotency_expiry.popleft()
+        record = idempotency_records.get(record_key)
+        if record is None or record["expires"] != expires:
+            # Dropped after a failure, or replaced by a later attempt with its own entry
+            continue
+        if record["future"].done():
+            del idempotency_records[record_key]
+        else:
+            record["expires"] = now + IDEMPOTENCY_TTL
+            idempotency_expiry.append((record["expires"], record_key))
+
+async def run_idempotent(key: Optional[str], scope: str, user_id: str, payload, handler: Callable[[], Awaitable]):
+    if not key:
+        return await handler()
+    if len(key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key must be at most 255 characters")
+    purge_idempotency_records()
+
+    record_key = (user_id, scope, key)
+    fingerprint = hashlib.sha256(json.dumps(jsonable_encoder(payload), sort_keys=True).encode()).hexdigest()
+    record = idempotency_records.get(record_key)
+    if record:
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        logger.info(f"Replaying idempotent {scope} request for user {user_id}, key {key}")
+        return await asyncio.shield(record["future"])
+
+    future = asyncio.get_running_loop().create_future()
+    expires = time.time() + IDEMPOTENCY_TTL
+    idempotency_records[record_key] = {"fingerprint": fingerprint, "future": future, "expires": expires}
+    idempotency_expiry.append((expires, record_key))
+    try:
+        result = await handler()
+    except BaseException as e:
+        # Failures are not stored, so a later retry runs again; in-flight duplicates get the same error
+        idempotency_records.pop(record_key, None)
+        future.set_exception(e if isinstance(e, Exception) else HTTPException(status_code=503, detail="Request was interrupted"))
+        future.exception()
+        raise
+    future.set_result(result)
+    return result
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 1))
+image_pool: Optional[ProcessPoolExecutor] = None
+
+def get_image_pool() -> ProcessPoolExecutor:
+    global image_pool
+    if image_pool is None:
+        image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return image_pool
+
+async def upload_image_derivatives(bucket: str, base_path: str, file_content: bytes) -> Dict[str, Dict[str, str]]:
+    """Build thumb/card/full derivatives off the event loop and upload them, returning public URLs."""
+    loop = asyncio.get_running_loop()
+    try:
+        derivatives = await loop.run_in_executor(get_image_pool(), image_utils.build_derivatives, file_content)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid image format")
+
+    def upload(path: str, content_type: str, data: bytes):
+        storage_response = supabase.storage.from_(bucket).upload(path, data, {"content-type": content_type})
+        if not storage_response:
+            raise HTTPException(status_code=500, detail="Failed to upload image to storage")
+        return supabase.storage.from_(bucket).get_public_url(path)
+
+    uploads = []
+    for size_name, formats in derivatives.items():
+        for ext, (content_type, data) in formats.items():
+            path = image_utils.derivative_path(base_path, size_name, ext)
+            uploads.append((size_name, ext, loop.run_in_executor(None, upload, path, content_type, data)))
+    public_urls = await asyncio.gather(*(task for _, _, task in uploads))
+
+    urls: Dict[str, Dict[str, str]] = {}
+    for (size_name, ext, _), public_url in zip(uploads, public_urls):
+        urls.setdefault(size_name, {})[ext] = public_url
+    return urls
+
 @app.on_event("startup")
 async def startup_event():
+    global expiry_task, demand_summary_task
     try:
         buckets = supabase.storage.list_buckets()
         logger.info(f"Available buckets: {[b['id'] for b in buckets]}")
     except Exception as e:
         logger.error(f"Error listing buckets on startup: {str(e)}")
+    # Warm the demand matcher before serving, so the first request routing does not load it
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, ensure_matcher_loaded)
+    except Exception as e:
+        logger.error(f"Error loading demand matcher on startup: {str(e)}")
+    if WANTED_EXPIRY_INTERVAL_SECONDS > 0:
+        expiry_task = asyncio.create_task(wanted_expiry_loop())
+    if DEMAND_SUMMARY_REFRESH_SECONDS > 0:
+        demand_summary_task = asyncio.create_task(demand_summary_loop())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if expiry_task is not None:
+        expiry_task.cancel()
+    if demand_summary_task is not None:
+        demand_summary_task.cancel()
+    if image_pool is not None:
+        image_pool.shutdown(wait=False)
 
 @app.post("/signup", response_model=SignupResponse)
 async def signup(signup_data: SignupRequest):
@@ -434,12 +903,16 @@ async def update_user(update_data: UserUpdate, session: dict = Depends(get_curre
             "experience": update_data.experience or "",
             "updated_at": datetime.utcnow().isoformat()
         }
+        point = geo_utils.geocode(update_data.address)
+        farmer_update["latitude"], farmer_update["longitude"] = point or (None, None)
         if farmer_details.data:
             farmer_update["photo_url"] = farmer_details.data[0]["photo_url"] or ""
             supabase.table("farmer_details").update(farmer_update).eq("user_id", session["user_id"]).execute()
         else:
             farmer_update["photo_url"] = ""
             supabase.table("farmer_details").insert(farmer_update).execute()
+        geo_index_seller(session["user_id"], update_data.address, point)
+        match_set_farmer(session["user_id"], update_data.main_crops)
 
         logger.info(f"Profile updated successfully for {session['email']}, farmer_details={farmer_update}")
         return UserResponse(
@@ -473,21 +946,14 @@ async def upload_profile_photo(file: UploadFile = File(...), session: dict = Dep
             logger.error(f"Unsupported file extension for {session['email']}: {file_extension}")
             raise HTTPException(status_code=400, detail="Unsupported image format")
         
-        file_path = f"{session['user_id']}/{uuid.uuid4()}.{file_extension}"
+        base_path = f"{session['user_id']}/{uuid.uuid4()}"
+        file_path = image_utils.derivative_path(base_path, "full", "jpg")
         logger.info(f"Generated file path for {session['email']}: {file_path}")
 
         file_content = await file.read()
-        storage_response = supabase.storage.from_("profile-photos").upload(
-            file_path,
-            file_content,
-            {"content-type": file.content_type}
-        )
-
-        if not storage_response:
-            logger.error(f"Failed to upload photo for {session['email']} to path: {file_path}")
-            raise HTTPException(status_code=500, detail="Failed to upload photo")
+        derivatives = await upload_image_derivatives("profile-photos", base_path, file_content)
 
-        public_url = supabase.storage.from_("profile-photos").get_public_url(file_path)
+        public_url = derivatives["full"]["jpg"]
         logger.info(f"Generated public URL for {session['email']}: {public_url}")
 
         try:
@@ -520,7 +986,7 @@ async def upload_profile_photo(file: UploadFile = File(...), session: dict = Dep
             logger.info(f"Inserted farmer_details for {session['email']} with photo_url: {public_url}")
 
         logger.info(f"Profile photo uploaded successfully for {session['email']}, stored URL: {public_url}")
-        return {"photo_url": public_url}
+        return {"photo_url": public_url, "derivatives": derivatives}
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -541,15 +1007,26 @@ async def delete_profile_photo(session: dict = Depends(get_current_session)):
         file_path = photo_url.split("profile-photos/")[-1].lstrip("public/")
         logger.info(f"Attempting to delete photo for {session['email']}: {file_path}")
 
+        # Photos uploaded through the derivative pipeline have one file per size and format
+        file_paths = [file_path]
+        if "_full." in file_path:
+            base_path = file_path.rsplit("_full.", 1)[0]
+            file_paths = [
+                image_utils.derivative_path(base_path, size_name, ext)
+                for size_name in image_utils.DERIVATIVE_SIZES
+                for ext in image_utils.DERIVATIVE_FORMATS
+            ]
+
         # Verify file exists
         files = supabase.storage.from_("profile-photos").list(session["user_id"])
-        file_exists = any(f['name'] == file_path.split('/')[-1] for f in files)
-        if not file_exists:
+        stored_names = {f['name'] for f in files}
+        existing_paths = [p for p in file_paths if p.split('/')[-1] in stored_names]
+        if not existing_paths:
             logger.warning(f"File not found in storage for {session['email']}: {file_path}")
             # Proceed to update database to avoid inconsistency
         else:
             # Delete the photo from Supabase Storage
-            storage_response = supabase.storage.from_("profile-photos").remove([file_path])
+            storage_response = supabase.storage.from_("profile-photos").remove(existing_paths)
             logger.info(f"Storage response: {storage_response}")
             if not storage_response:
                 logger.error(f"Failed to delete photo for {session['email']}: {file_path}")
@@ -767,36 +1244,212 @@ async def submit_feedback(feedback: dict, session: dict = Depends(get_current_se
         logger.error(f"Feedback error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error submitting feedback: {str(e)}")
 
+# Catalog response cache: entries are stamped with the version of every scope
+# they depend on ("all", "category:<name>", "seller:<id>", "product:<id>") and
+# product/stock writes bump those versions instead of deleting entries.
+CATALOG_CACHE_TTL = int(os.getenv("CATALOG_CACHE_TTL", 60))
+CATALOG_CACHE_MAX_ENTRIES = int(os.getenv("CATALOG_CACHE_MAX_ENTRIES", 1000))
+
+catalog_versions: Dict[str, int] = {}
+catalog_cache: Dict[str, dict] = {}
+
+def bump_catalog_version(product_id: Optional[str] = None, category: Optional[str] = None, seller_id: Optional[str] = None):
+    scopes = ["all"]
+    if product_id:
+        scopes.append(f"product:{product_id}")
+    if category:
+        scopes.append(f"category:{category}")
+    if seller_id:
+        scopes.append(f"seller:{seller_id}")
+    for scope in scopes:
+        catalog_versions[scope] = catalog_versions.get(scope, 0) + 1
+    logger.debug(f"Bumped catalog versions: {scopes}")
+
+def catalog_stamp(scopes: List[str]) -> tuple:
+    return tuple(catalog_versions.get(scope, 0) for scope in scopes)
+
+def catalog_cache_get(key: str, scopes: List[str]) -> Optional[dict]:
+    entry = catalog_cache.get(key)
+    if not entry:
+        return None
+    if entry["expires"] < time.time() or entry["stamp"] != catalog_stamp(scopes):
+        del catalog_cache[key]
+        return None
+    return entry
+
+def catalog_cache_put(key: str, stamp: tuple, data) -> dict:
+    body = json.dumps(jsonable_encoder(data), sort_keys=True, separators=(",", ":"))
+    entry = {
+        "stamp": stamp,
+        "expires": time.time() + CATALOG_CACHE_TTL,
+        "body": body,
+        "etag": f'"{hashlib.md5(body.encode()).hexdigest()}"'
+    }
+    catalog_cache.pop(key, None)
+    while len(catalog_cache) >= CATALOG_CACHE_MAX_ENTRIES:
+        catalog_cache.pop(next(iter(catalog_cache)))
+    catalog_cache[key] = entry
+    return entry
+
+def catalog_response(entry: dict, if_none_match: Optional[str], cache_control: str = "private, no-cache") -> Response:
+    headers = {"ETag": entry["etag"], "Cache-Control": cache_control}
+    if if_none_match and entry["etag"] in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["body"], media_type="application/json", headers=headers)
+
+# Facet aggregates: per-scope counters of (category, unit, price bucket, in stock),
+# loaded once and then maintained by the product and stock write paths. They live in
+# this process, so writes made through another worker show up after its restart.
+# Product names are indexed by trigram for the q filter.
+PRICE_BUCKETS = [(0, 100, "0-100"), (100, 500, "100-500"), (500, 1000, "500-1000"), (1000, 5000, "1000-5000"), (5000, None, "5000+")]
+
+facet_products: Dict[str, dict] = {}
+facet_counts: Dict[Optional[str], Counter] = {}
+facet_trigrams: Dict[str, set] = {}
+facets_loaded = False
+
+def price_bucket(price: float) -> str:
+    for low, high, label in PRICE_BUCKETS:
+        if high is None or price < high:
+            return label
+    return PRICE_BUCKETS[-1][2]
+
+def name_trigrams(text: str) -> set:
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def facet_key(entry: dict) -> tuple:
+    return (entry["category"], entry["unit"], price_bucket(entry["price"]), entry["quantity"] > 0)
+
+def facet_adjust(entry: dict, delta: int):
+    key = facet_key(entry)
+    for scope in (None, entry["seller_id"]):
+        counts = facet_counts.setdefault(scope, Counter())
+        counts[key] += delta
+        if counts[key] <= 0:
+            del counts[key]
+
+def facet_upsert(row: dict):
+    if not facets_loaded:
+        return
+    facet_remove(row["id"])
+    entry = {k: row[k] for k in ("seller_id", "category", "unit", "price", "quantity", "name")}
+    facet_products[row["id"]] = entry
+    facet_adjust(entry, 1)
+    for gram in name_trigrams(entry["name"]):
+        facet_trigrams.setdefault(gram, set()).add(row["id"])
+
+def facet_remove(product_id: str):
+    entry = facet_products.pop(product_id, None) if facets_loaded else None
+    if entry:
+        facet_adjust(entry, -1)
+        for gram in name_trigrams(entry["name"]):
+            ids = facet_trigrams.get(gram)
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del facet_trigrams[gram]
+
+def facet_set_quantity(product_id: str, quantity: float):
+    entry = facet_products.get(product_id) if facets_loaded else None
+    if entry:
+        facet_upsert({"id": product_id, **entry, "quantity": quantity})
+
+def ensure_facets_loaded():
+    global facets_loaded
+    if facets_loaded:
+        return
+    page_size = 1000
+    offset = 0
+    facets_loaded = True
+    try:
+        while True:
+            page = supabase.table("products").select("id, seller_id, category, unit, price, quantity, name").range(offset, offset + page_size - 1).execute()
+            for row in page.data:
+                facet_upsert(row)
+            if len(page.data) < page_size:
+                break
+            offset += page_size
+    except Exception:
+        facets_loaded = False
+        facet_products.clear()
+        facet_counts.clear()
+        facet_trigrams.clear()
+        raise
+    logger.info(f"Loaded facet aggregates for {len(facet_products)} products")
+
+def compute_facets(seller_id: Optional[str], category: Optional[str], q: Optional[str]) -> dict:
+    if q:
+        # Text search has no precomputed aggregate; only products sharing every trigram
+        # of q are checked. Queries under three characters still scan every entry.
+        needle = q.lower()
+        grams = sorted((facet_trigrams.get(gram, set()) for gram in name_trigrams(needle)), key=len)
+        candidate_ids = set.intersection(*grams) if grams else facet_products.keys()
+        entries = (facet_products[product_id] for product_id in candidate_ids)
+        counts = Counter(
+            facet_key(entry) for entry in entries
+            if needle in entry["name"].lower() and (not seller_id or entry["seller_id"] == seller_id)
+        )
+    else:
+        counts = facet_counts.get(seller_id or None, Counter())
+
+    result = {"category": {}, "unit": {}, "price": {}, "availability": {}, "total": 0}
+    for (cat, unit, bucket, in_stock), count in counts.items():
+        # Category counts ignore the category filter so the UI can show alternatives
+        result["category"][cat] = result["category"].get(cat, 0) + count
+        if category and cat != category:
+            continue
+        result["unit"][unit] = result["unit"].get(unit, 0) + count
+        result["price"][bucket] = result["price"].get(bucket, 0) + count
+        availability = "in_stock" if in_stock else "out_of_stock"
+        result["availability"][availability] = result["availability"].get(availability, 0) + count
+        result["total"] += count
+    return result
+
+PRODUCT_CATEGORIES = ["Seeds", "Fertilizers", "Pesticides", "Tools"]
+PRODUCT_UNITS = ["kg", "g", "L", "pcs"]
+PRODUCT_BULK_BATCH_SIZE = int(os.getenv("PRODUCT_BULK_BATCH_SIZE", 500))
+
+def validate_product(product: Product):
+    if product.quantity <= 0 or product.price <= 0:
+        raise HTTPException(status_code=400, detail="Quantity and price must be positive")
+    if len(product.name) > 100:
+        raise HTTPException(status_code=400, detail="Name must be under 100 characters")
+    if product.description and len(product.description) > 500:
+        raise HTTPException(status_code=400, detail="Description must be under 500 characters")
+    if product.category not in PRODUCT_CATEGORIES:
+        raise HTTPException(status_code=400, detail="Invalid category")
+    if product.unit not in PRODUCT_UNITS:
+        raise HTTPException(status_code=400, detail="Invalid unit")
+
+def build_product_row(product: Product, seller_id: str) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "name": product.name,
+        "category": product.category,
+        "quantity": product.quantity,
+        "unit": product.unit,
+        "price": product.price,
+        "description": product.description,
+        "image": product.image or "/lovable-Uploads/dfae19bc-0068-4451-9902-2b41432ac120.png",
+        "seller_id": seller_id,
+        "created_at": "now()"
+    }
+
 @app.post("/products", response_model=Product)
-async def add_product(product: Product, session: dict = Depends(get_session)):
-    try:
-        if product.quantity <= 0 or product.price <= 0:
-            raise HTTPException(status_code=400, detail="Quantity and price must be positive")
-        if len(product.name) > 100:
-            raise HTTPException(status_code=400, detail="Name must be under 100 characters")
-        if product.description and len(product.description) > 500:
-            raise HTTPException(status_code=400, detail="Description must be under 500 characters")
-        valid_categories = ["Seeds", "Fertilizers", "Pesticides", "Tools"]
-        valid_units = ["kg", "g", "L", "pcs"]
-        if product.category not in valid_categories:
-            raise HTTPException(status_code=400, detail="Invalid category")
-        if product.unit not in valid_units:
-            raise HTTPException(status_code=400, detail="Invalid unit")
-        product_data = {
-            "id": str(uuid.uuid4()),
-            "name": product.name,
-            "category": product.category,
-            "quantity": product.quantity,
-            "unit": product.unit,
-            "price": product.price,
-            "description": product.description,
-            "image": product.image or "/lovable-Uploads/dfae19bc-0068-4451-9902-2b41432ac120.png",
-            "seller_id": session["user_id"],
-            "created_at": "now()"
-        }
+async def add_product(product: Product, idempotency_key: Optional[str] = Header(None), session: dict = Depends(get_session)):
+    return await run_idempotent(idempotency_key, "products", session["user_id"], product, lambda: insert_product(product, session))
+
+async def insert_product(product: Product, session: dict):
+    try:
+        validate_product(product)
+        product_data = build_product_row(product, session["user_id"])
         response = supabase.table("products").insert(product_data).execute()
         if not response.data:
             raise HTTPException(status_code=500, detail="Failed to add product")
+        bump_catalog_version(product_data["id"], product_data["category"], session["user_id"])
+        facet_upsert(response.data[0])
+        match_index_listing(response.data[0])
         logger.info(f"Product added by {session['email']}: {product_data['name']}")
         return response.data[0]
     except HTTPException as e:
@@ -812,15 +1465,16 @@ async def upload_product_image(file: UploadFile = File(...), session: dict = Dep
         if file_extension not in ['jpg', 'jpeg', 'png']:
             logger.error(f"Unsupported file extension: {file_extension} by {session['email']}")
             raise HTTPException(status_code=400, detail="Unsupported image format")
-        file_path = f"products/{session['user_id']}/{uuid.uuid4()}.{file_extension}"
+        base_path = f"products/{session['user_id']}/{uuid.uuid4()}"
         file_content = await file.read()
-        storage_response = supabase.storage.from_("product-images").upload(file_path, file_content, {"content-type": file.content_type})
-        if not storage_response:
-            logger.error(f"Storage upload failed for {session['email']}: {file_path}")
-            raise HTTPException(status_code=500, detail="Failed to upload image to storage")
-        public_url = supabase.storage.from_("product-images").get_public_url(file_path)
+        derivatives = await upload_image_derivatives("product-images", base_path, file_content)
+        public_url = derivatives["full"]["jpg"]
         logger.info(f"Product image uploaded by {session['email']}: {public_url}")
-        return {"image_url": public_url}
+        return {
+            "image_url": public_url,
+            "thumbnail_url": derivatives["thumb"]["webp"],
+            "derivatives": derivatives
+        }
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -829,6 +1483,194 @@ async def upload_product_image(file: UploadFile = File(...), session: dict = Dep
             raise HTTPException(status_code=404, detail="Storage bucket 'product-images' not found")
         raise HTTPException(status_code=500, detail=f"Error uploading image: {str(e)}")
 
+async def iter_body_lines(request: Request):
+    """Yield raw lines from the request body without buffering the whole upload.
+
+    Lines are decoded by the caller, so one badly encoded row can be reported on its own.
+    """
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if buffer:
+        yield buffer.rstrip(b"\r")
+
+def insert_product_batch(batch: List[tuple], errors: List[dict], seller_id: str) -> int:
+    try:
+        response = supabase.table("products").insert([row for _, row in batch]).execute()
+        inserted = len(response.data or [])
+    except Exception as e:
+        logger.error(f"Bulk insert batch failed for seller {seller_id}: {str(e)}")
+        errors.extend({"row": row_number, "error": f"Insert failed: {str(e)}"} for row_number, _ in batch)
+        return 0
+    for category in {row["category"] for _, row in batch}:
+        bump_catalog_version(category=category, seller_id=seller_id)
+    for row in response.data or []:
+        facet_upsert(row)
+        match_index_listing(row)
+    return inserted
+
+@app.post("/products/bulk")
+async def bulk_add_products(request: Request, session: dict = Depends(get_session)):
+    """Stream a CSV (with header row) or NDJSON body and insert products in batches.
+
+    Rows are validated like POST /products. CSV rows must not contain embedded newlines.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type in ["text/csv", "application/csv"]:
+        is_csv = True
+    elif content_type in ["application/x-ndjson", "application/ndjson", "application/jsonl"]:
+        is_csv = False
+    else:
+        raise HTTPException(status_code=415, detail="Content-Type must be text/csv or application/x-ndjson")
+
+    try:
+        header = None
+        batch: List[tuple] = []
+        errors: List[dict] = []
+        inserted = 0
+        row_number = 0
+        async for raw_line in iter_body_lines(request):
+            if not raw_line.strip():
+                continue
+            if is_csv and header is None:
+                try:
+                    header = [h.strip() for h in next(csv.reader([raw_line.decode("utf-8-sig")]))]
+                except UnicodeDecodeError:
+                    raise HTTPException(status_code=400, detail="CSV header must be UTF-8 encoded")
+                except csv.Error as e:
+                    raise HTTPException(status_code=400, detail=f"Invalid CSV header: {str(e)}")
+                continue
+            row_number += 1
+            try:
+                try:
+                    line = raw_line.decode("utf-8-sig")
+                except UnicodeDecodeError:
+                    raise ValueError("invalid UTF-8")
+                if is_csv:
+                    values = next(csv.reader([line]))
+                    if len(values) != len(header):
+                        raise ValueError(f"Expected {len(header)} columns, got {len(values)}")
+                    raw = {k: (v if v != "" else None) for k, v in zip(header, values)}
+                else:
+                    raw = json.loads(line)
+                    if not isinstance(raw, dict):
+                        raise ValueError("Each line must be a JSON object")
+                product = Product(**raw)
+                validate_product(product)
+            except HTTPException as e:
+                errors.append({"row": row_number, "error": e.detail})
+                continue
+            except (ValueError, TypeError, csv.Error) as e:
+                errors.append({"row": row_number, "error": str(e)})
+                continue
+
+            batch.append((row_number, build_product_row(product, session["user_id"])))
+            if len(batch) >= PRODUCT_BULK_BATCH_SIZE:
+                inserted += insert_product_batch(batch, errors, session["user_id"])
+                batch = []
+        if batch:
+            inserted += insert_product_batch(batch, errors, session["user_id"])
+
+        logger.info(f"Bulk import by {session['email']}: {row_number} rows, {inserted} inserted, {len(errors)} errors")
+        return {"total_rows": row_number, "inserted": inserted, "failed": len(errors), "errors": errors}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Error in bulk product import for {session['email']}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error importing products: {str(e)}")
+
+@app.patch("/products/batch")
+async def batch_update_products(updates: List[ProductPatch], session: dict = Depends(get_session)):
+    try:
+        if not updates:
+            raise HTTPException(status_code=400, detail="No updates provided")
+        if len(updates) > PRODUCT_BULK_BATCH_SIZE:
+            raise HTTPException(status_code=400, detail=f"At most {PRODUCT_BULK_BATCH_SIZE} updates per batch")
+
+        results = {}
+        valid_ids = []
+        for update in updates:
+            try:
+                uuid.UUID(update.id)
+                valid_ids.append(update.id)
+            except ValueError:
+                results[update.id] = {"id": update.id, "status": "error", "error": "Invalid product ID format"}
+
+        # One ownership check for the whole batch
+        existing = {}
+        if valid_ids:
+            owned = supabase.table("products").select("*").in_("id", list(set(valid_ids))).eq("seller_id", session["user_id"]).execute()
+            existing = {p["id"]: p for p in owned.data}
+
+        # Only the patched columns are sent, so concurrent stock changes are not overwritten
+        patches = {}
+        for update in updates:
+            if update.id in results:
+                continue
+            if update.id not in existing:
+                results[update.id] = {"id": update.id, "status": "error", "error": "Product not found or you don't have permission to edit it"}
+                continue
+            changes = {**patches.get(update.id, {}), **update.model_dump(exclude={"id"}, exclude_unset=True)}
+            merged = {**existing[update.id], **changes}
+            try:
+                validate_product(Product(**merged))
+            except HTTPException as e:
+                results[update.id] = {"id": update.id, "status": "error", "error": e.detail}
+                continue
+            except ValueError as e:
+                results[update.id] = {"id": update.id, "status": "error", "error": str(e)}
+                continue
+            patches[update.id] = changes
+
+        if patches:
+            # Updates existing rows only; a product deleted since the ownership check is not re-created
+            response = supabase.rpc("apply_product_patches", {
+                "p_seller_id": session["user_id"],
+                "p_patches": [{"id": product_id, **changes} for product_id, changes in patches.items()]
+            }).execute()
+            for row in response.data or []:
+                old = existing[row["id"]]
+                bump_catalog_version(row["id"], old["category"], session["user_id"])
+                if row["category"] != old["category"]:
+                    bump_catalog_version(category=row["category"])
+                facet_upsert(row)
+                match_index_listing(row)
+                results[row["id"]] = {"id": row["id"], "status": "updated", "product": row}
+            for product_id in patches:
+                results.setdefault(product_id, {"id": product_id, "status": "error", "error": "Product not found or you don't have permission to edit it"})
+
+        updated = sum(1 for r in results.values() if r["status"] == "updated")
+        logger.info(f"Batch update by {session['email']}: {updated} updated, {len(results) - updated} failed")
+        return {"updated": updated, "failed": len(results) - updated, "results": list(results.values())}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Error in batch product update for {session['email']}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error updating products: {str(e)}")
+
+@app.get("/products/facets")
+async def get_product_facets(
+    seller_id: str | None = None,
+    q: str | None = None,
+    category: str | None = None,
+    session: dict = Depends(get_session)
+):
+    try:
+        if category not in PRODUCT_CATEGORIES:
+            category = None
+        ensure_facets_loaded()
+        facets = compute_facets(seller_id, category, q)
+        logger.info(f"Computed facets for seller_id: {seller_id}, query: {q}, category: {category}")
+        return facets
+    except Exception as e:
+        logger.error(f"Error computing product facets for {session['email']}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error computing facets: {str(e)}")
+
+PRODUCT_FIELDS = ["id", "name", "category", "quantity", "unit", "price", "description", "image", "seller_id", "created_at", "updated_at"]
+
 @app.get("/products")
 async def get_products(
     seller_id: str | None = None,
@@ -836,26 +1678,66 @@ async def get_products(
     category: str | None = None,
     limit: int = 10,
     offset: int = 0,
+    fields: str | None = None,
+    near: str | None = None,
+    radius_km: float = 50,
+    if_none_match: Optional[str] = Header(None),
     session: dict = Depends(get_session)
 ):
     try:
-        query = supabase.table("products").select("*")
+        if category not in PRODUCT_CATEGORIES:
+            category = None
+        origin = parse_near(near, radius_km)
+        scopes = []
+        if category:
+            scopes.append(f"category:{category}")
+        if seller_id:
+            scopes.append(f"seller:{seller_id}")
+        scopes = scopes or ["all"]
+        if origin:
+            scopes.append("geo")
+        select_fields = parse_fields(fields, PRODUCT_FIELDS)
+        cache_key = f"products:{seller_id}:{q}:{category}:{limit}:{offset}:{select_fields}:{origin}:{radius_km if origin else None}"
+        entry = catalog_cache_get(cache_key, scopes)
+        if entry:
+            logger.info(f"Serving cached products for key: {cache_key}")
+            return catalog_response(entry, if_none_match)
+        stamp = catalog_stamp(scopes)
+
+        query = supabase.table("products").select(select_fields)
+        seller_distances = {}
+        if origin:
+            ensure_geo_loaded()
+            # Nearest sellers first, capped so the seller_id filter stays a bounded URL
+            seller_distances = dict(seller_geo_index.query(origin[0], origin[1], radius_km)[:GEO_MAX_SELLERS])
+            if not seller_distances:
+                entry = catalog_cache_put(cache_key, stamp, [])
+                return catalog_response(entry, if_none_match)
+            query = query.in_("seller_id", list(seller_distances))
         if seller_id:
             query = query.eq("seller_id", seller_id)
         if q:
             query = query.ilike("name", f"%{q}%")
-        if category and category in ["Seeds", "Fertilizers", "Pesticides", "Tools"]:
+        if category:
             query = query.eq("category", category)
         query = query.range(offset, offset + limit - 1)
         response = query.execute()
         logger.info(f"Fetched {len(response.data)} products for seller_id: {seller_id}, query: {q}, category: {category}, limit: {limit}, offset: {offset}")
-        return response.data
+        for row in response.data:
+            if "image" in row:
+                row["thumbnail"] = image_utils.thumbnail_url(row["image"])
+            if origin and row.get("seller_id") in seller_distances:
+                row["distance_km"] = round(seller_distances[row["seller_id"]], 1)
+        entry = catalog_cache_put(cache_key, stamp, response.data)
+        return catalog_response(entry, if_none_match)
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error fetching products for {session['email']}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching products: {str(e)}")
 
 @app.get("/products/{product_id}", response_model=Product)
-async def get_product(product_id: str, session: dict = Depends(get_session)):
+async def get_product(product_id: str, if_none_match: Optional[str] = Header(None), session: dict = Depends(get_session)):
     try:
         try:
             uuid.UUID(product_id)
@@ -863,12 +1745,21 @@ async def get_product(product_id: str, session: dict = Depends(get_session)):
             logger.error(f"Invalid product_id format: {product_id}")
             raise HTTPException(status_code=400, detail="Invalid product ID format")
 
+        scopes = [f"product:{product_id}"]
+        cache_key = f"product:{product_id}"
+        entry = catalog_cache_get(cache_key, scopes)
+        if entry:
+            logger.info(f"Serving cached product {product_id} for {session['email']}")
+            return catalog_response(entry, if_none_match)
+        stamp = catalog_stamp(scopes)
+
         response = supabase.table("products").select("*").eq("id", product_id).single().execute()
         if not response.data:
             logger.error(f"Product not found: {product_id}")
             raise HTTPException(status_code=404, detail="Product not found")
         logger.info(f"Fetched product {product_id} for {session['email']}")
-        return response.data
+        entry = catalog_cache_put(cache_key, stamp, Product(**response.data))
+        return catalog_response(entry, if_none_match)
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -878,42 +1769,42 @@ async def get_product(product_id: str, session: dict = Depends(get_session)):
 @app.put("/products/{product_id}", response_model=Product)
 async def update_product(product_id: str, product: Product, session: dict = Depends(get_session)):
     try:
-        if product.quantity <= 0 or product.price <= 0:
-            raise HTTPException(status_code=400, detail="Quantity and price must be positive")
-        if len(product.name) > 100:
-            raise HTTPException(status_code=400, detail="Name must be under 100 characters")
-        if product.description and len(product.description) > 500:
-            raise HTTPException(status_code=400, detail="Description must be under 500 characters")
-        valid_categories = ["Seeds", "Fertilizers", "Pesticides", "Tools"]
-        valid_units = ["kg", "g", "L", "pcs"]
-        if product.category not in valid_categories:
-            raise HTTPException(status_code=400, detail="Invalid category")
-        if product.unit not in valid_units:
-            raise HTTPException(status_code=400, detail="Invalid unit")
+        validate_product(product)
         try:
             uuid.UUID(product_id)
         except ValueError:
             logger.error(f"Invalid product_id format: {product_id}")
             raise HTTPException(status_code=400, detail="Invalid product ID format")
-        existing_product = supabase.table("products").select("*").eq("id", product_id).eq("seller_id", session["user_id"]).single().execute()
-        if not existing_product.data:
-            raise HTTPException(status_code=404, detail="Product not found or you don't have permission to edit it")
-        
         product_data = {
             "name": product.name,
             "category": product.category,
             "quantity": product.quantity,
             "unit": product.unit,
             "price": product.price,
-            "description": product.description,
-            "image": product.image or existing_product.data["image"],
-            "updated_at": datetime.utcnow().isoformat()
+            "description": product.description
         }
-        response = supabase.table("products").update(product_data).eq("id", product_id).eq("seller_id", session["user_id"]).execute()
-        if not response.data:
-            raise HTTPException(status_code=500, detail="Failed to update product")
+        if product.image:
+            product_data["image"] = product.image
+        # The write also returns the previous category, so both listings are invalidated
+        updated = mutate_or_raise(
+            supabase.rpc("update_product_returning_previous", {
+                "p_product_id": product_id,
+                "p_seller_id": session["user_id"],
+                "p_product": product_data
+            }),
+            "products",
+            product_id,
+            "Product not found",
+            "You don't have permission to edit this product"
+        )
+        previous_category = updated[0].pop("previous_category")
+        for category in {previous_category, updated[0]["category"]}:
+            bump_catalog_version(category=category)
+        bump_catalog_version(product_id, seller_id=session["user_id"])
+        facet_upsert(updated[0])
+        match_index_listing(updated[0])
         logger.info(f"Product updated by {session['email']}: {product_id}")
-        return response.data[0]
+        return updated[0]
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -929,13 +1820,16 @@ async def delete_product(product_id: str, session: dict = Depends(get_session)):
             logger.error(f"Invalid product_id format: {product_id}")
             raise HTTPException(status_code=400, detail="Invalid product ID format")
 
-        existing_product = supabase.table("products").select("*").eq("id", product_id).eq("seller_id", session["user_id"]).single().execute()
-        if not existing_product.data:
-            raise HTTPException(status_code=404, detail="Product not found or you don't have permission to delete it")
-        
-        response = supabase.table("products").delete().eq("id", product_id).eq("seller_id", session["user_id"]).execute()
-        if not response.data:
-            raise HTTPException(status_code=500, detail="Failed to delete product")
+        deleted = mutate_or_raise(
+            supabase.table("products").delete().eq("id", product_id).eq("seller_id", session["user_id"]),
+            "products",
+            product_id,
+            "Product not found",
+            "You don't have permission to delete this product"
+        )
+        bump_catalog_version(product_id, deleted[0]["category"], session["user_id"])
+        facet_remove(product_id)
+        match_remove_listing(product_id)
         logger.info(f"Product deleted by {session['email']}: {product_id}")
         return {"message": "Product deleted successfully"}
     except HTTPException as e:
@@ -945,7 +1839,10 @@ async def delete_product(product_id: str, session: dict = Depends(get_session)):
         raise HTTPException(status_code=500, detail=f"Error deleting product: {str(e)}")
 
 @app.post("/orders")
-async def create_order(order: Order, session: dict = Depends(get_session)):
+async def create_order(order: Order, idempotency_key: Optional[str] = Header(None), session: dict = Depends(get_session)):
+    return await run_idempotent(idempotency_key, "orders", session["user_id"], order, lambda: place_order(order, session))
+
+async def place_order(order: Order, session: dict):
     try:
         # Validate delivery info
         required_delivery_fields = ["full_name", "phone_number", "address", "city", "state", "pin_code"]
@@ -968,7 +1865,7 @@ async def create_order(order: Order, session: dict = Depends(get_session)):
             raise HTTPException(status_code=400, detail="No products in order")
         
         product_ids = [item.id for item in order.products]
-        products = supabase.table("products").select("id, name, quantity, price, seller_id").in_("id", product_ids).execute()
+        products = supabase.table("products").select("id, name, quantity, price, seller_id, category").in_("id", product_ids).execute()
         product_dict = {p["id"]: p for p in products.data}
 
         for item in order.products:
@@ -989,13 +1886,17 @@ async def create_order(order: Order, session: dict = Depends(get_session)):
             if abs(item.price - db_product["price"]) > 0.01:
                 raise HTTPException(status_code=400, detail=f"Price mismatch for {item.name}. Current price: {db_product['price']}")
 
-        # Update product quantities and add seller_id to order items
+        # Calculate total
+        items_total = sum(item.price * item.quantity for item in order.products)
+        delivery_fee = 40 if order.delivery_method == "parcel" else 0
+        calculated_total = items_total + delivery_fee
+        if abs(order.total - calculated_total) > 0.01:
+            raise HTTPException(status_code=400, detail=f"Total mismatch. Expected: {calculated_total}, Provided: {order.total}")
+
+        # Add seller_id to order items
         order_products = []
         for item in order.products:
             db_product = product_dict[item.id]
-            new_quantity = db_product["quantity"] - item.quantity
-            supabase.table("products").update({"quantity": new_quantity}).eq("id", item.id).execute()
-            logger.info(f"Updated quantity for product {item.id}: {new_quantity}")
             order_products.append({
                 "id": item.id,
                 "name": item.name,
@@ -1004,13 +1905,6 @@ async def create_order(order: Order, session: dict = Depends(get_session)):
                 "seller_id": db_product["seller_id"]
             })
 
-        # Calculate total
-        items_total = sum(item.price * item.quantity for item in order.products)
-        delivery_fee = 40 if order.delivery_method == "parcel" else 0
-        calculated_total = items_total + delivery_fee
-        if abs(order.total - calculated_total) > 0.01:
-            raise HTTPException(status_code=400, detail=f"Total mismatch. Expected: {calculated_total}, Provided: {order.total}")
-
         # Create order
         order_data = {
             "id": str(uuid.uuid4()),
@@ -1027,18 +1921,47 @@ async def create_order(order: Order, session: dict = Depends(get_session)):
             "updated_at": datetime.utcnow().isoformat(),
             "delivery_fee": delivery_fee
         }
-        response = supabase.table("orders").insert(order_data).execute()
-        if not response.data:
+        # Decrement every line item and insert the order in one transaction
+        reservation = supabase.rpc("create_order_with_reservation", {
+            "p_order": order_data,
+            "p_items": [{"id": item.id, "quantity": item.quantity} for item in order.products]
+        }).execute().data
+        if not reservation:
             raise HTTPException(status_code=500, detail="Failed to create order")
+        if not reservation["ok"]:
+            shortfalls = [
+                {**shortfall, "name": product_dict.get(shortfall["id"], {}).get("name")}
+                for shortfall in reservation["shortfalls"]
+            ]
+            logger.warning(f"Stock reservation failed for {session['email']}: {shortfalls}")
+            raise HTTPException(status_code=409, detail={"message": "Insufficient stock", "shortfalls": shortfalls})
+
+        for stock in reservation["stock"]:
+            db_product = product_dict[stock["id"]]
+            bump_catalog_version(stock["id"], db_product["category"], db_product["seller_id"])
+            facet_set_quantity(stock["id"], stock["quantity"])
+            match_set_stock(stock["id"], stock["quantity"])
+            logger.info(f"Updated quantity for product {stock['id']}: {stock['quantity']}")
 
         logger.info(f"Order created by {session['email']}: {order_data['id']}")
-        return response.data[0]
+        return reservation["order"]
     except HTTPException as e:
         raise e
     except Exception as e:
         logger.error(f"Error creating order for {session['email']}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error creating order: {str(e)}")
 
+@app.post("/events/token")
+async def create_stream_token(x_session_id: str = Header(...), session: dict = Depends(get_session)):
+    # get_session authenticates; the token is bound to the session ID so logout revokes it
+    logger.info(f"Stream token issued for {session['email']}")
+    return {"token": issue_stream_token(x_session_id), "expires_in": STREAM_TOKEN_TTL}
+
+@app.get("/orders/events")
+async def stream_order_events(request: Request, session: dict = Depends(get_stream_session)):
+    logger.info(f"Order event stream opened for {session['email']}")
+    return event_stream_response(request, "order", session["user_id"])
+
 @app.get("/orders/{order_id}")
 async def get_order(order_id: str, session: dict = Depends(get_session)):
     try:
@@ -1061,33 +1984,169 @@ async def get_order(order_id: str, session: dict = Depends(get_session)):
         logger.error(f"Error fetching order {order_id} for {session['email']}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching order: {str(e)}")
 
+ORDER_FIELDS = ["id", "buyer_id", "products", "total_price", "delivery", "status", "delivery_method", "payment_method", "pickup_time", "tracking_link", "created_at", "updated_at", "delivery_fee"]
+
+ORDER_STATUSES = ["Pending", "Processing", "Ready for Pickup", "Packed", "Shipped", "Delivered", "Cancelled"]
+
+SELLER_ORDERS_BATCH_SIZE = 200
+
+def apply_order_filters(
+    query,
+    status: Optional[str],
+    delivery_method: Optional[str],
+    created_from: Optional[datetime],
+    created_to: Optional[datetime],
+    min_total: Optional[float],
+    max_total: Optional[float]
+):
+    if status:
+        statuses = [s.strip() for s in status.split(",") if s.strip()]
+        invalid = [s for s in statuses if s not in ORDER_STATUSES]
+        if invalid:
+            raise HTTPException(status_code=400, detail=f"Invalid status: {invalid}")
+        query = query.in_("status", statuses)
+    if delivery_method:
+        if delivery_method not in ["self_pickup", "parcel"]:
+            raise HTTPException(status_code=400, detail="Invalid delivery method")
+        query = query.eq("delivery_method", delivery_method)
+    if created_from:
+        query = query.gte("created_at", created_from.isoformat())
+    if created_to:
+        query = query.lte("created_at", created_to.isoformat())
+    if min_total is not None:
+        query = query.gte("total_price", min_total)
+    if max_total is not None:
+        query = query.lte("total_price", max_total)
+    return query
+
+def check_page(limit: Optional[int], offset: int, count: Optional[str]):
+    if limit is not None and (limit <= 0 or limit > 500):
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 500")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="offset must be non-negative")
+    if count is not None and count not in ["exact", "estimated", "planned"]:
+        raise HTTPException(status_code=400, detail="count must be exact, estimated or planned")
+
 @app.get("/orders")
-async def get_user_orders(session: dict = Depends(get_session)):
+async def get_user_orders(
+    response: Response,
+    fields: str | None = None,
+    status: str | None = None,
+    delivery_method: str | None = None,
+    created_from: datetime | None = None,
+    created_to: datetime | None = None,
+    min_total: float | None = None,
+    max_total: float | None = None,
+    limit: int | None = None,
+    offset: int = 0,
+    count: str | None = None,
+    session: dict = Depends(get_session)
+):
     try:
-        response = supabase.table("orders").select("*").eq("buyer_id", session["user_id"]).execute()
-        logger.info(f"Fetched {len(response.data)} orders for {session['email']}")
-        return response.data
+        # X-Total-Count is opt-in (?count=exact|estimated|planned), so plain listings skip the count
+        check_page(limit, offset, count)
+        select_fields = parse_fields(fields, ORDER_FIELDS)
+        query = supabase.table("orders").select(select_fields, count=count).eq("buyer_id", session["user_id"])
+        query = apply_order_filters(query, status, delivery_method, created_from, created_to, min_total, max_total)
+        query = query.order("created_at", desc=True)
+        if limit is not None:
+            query = query.range(offset, offset + limit - 1)
+        result = query.execute()
+        if result.count is not None:
+            response.headers["X-Total-Count"] = str(result.count)
+        logger.info(f"Fetched {len(result.data)} orders for {session['email']}")
+        return result.data
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error fetching orders for {session['email']}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching orders: {str(e)}")
 
 @app.get("/seller/orders")
-async def get_seller_orders(session: dict = Depends(get_session)):
+async def get_seller_orders(
+    response: Response,
+    status: str | None = None,
+    delivery_method: str | None = None,
+    created_from: datetime | None = None,
+    created_to: datetime | None = None,
+    min_total: float | None = None,
+    max_total: float | None = None,
+    limit: int | None = None,
+    offset: int = 0,
+    count: str | None = None,
+    session: dict = Depends(get_session)
+):
     try:
-        orders = supabase.table("orders").select("*").execute().data
+        # X-Total-Count is opt-in (?count=exact|estimated|planned), and only the first batch counts
+        check_page(limit, offset, count)
+
+        def index_page(start: int, size: int):
+            # This seller's orders via the order_items index, newest first
+            query = supabase.table("seller_order_index").select("order_id, items", count=count if start == offset else None).eq("seller_id", session["user_id"])
+            query = apply_order_filters(query, status, delivery_method, created_from, created_to, min_total, max_total)
+            return query.order("created_at", desc=True).order("order_id").range(start, start + size - 1).execute()
+
+        # Without limit every matching order is returned, read in batches that keep the in_() URL short
+        size = limit if limit is not None else SELLER_ORDERS_BATCH_SIZE
         seller_orders = []
-        for order in orders:
-            seller_products = [p for p in order["products"] if p.get("seller_id") == session["user_id"]]
-            if seller_products:
-                order_copy = order.copy()
-                order_copy["products"] = seller_products
-                seller_orders.append(order_copy)
+        start = offset
+        while True:
+            index = index_page(start, size)
+            if start == offset and index.count is not None:
+                response.headers["X-Total-Count"] = str(index.count)
+            if index.data:
+                orders = supabase.table("orders").select("*").in_("id", [row["order_id"] for row in index.data]).execute()
+                orders_by_id = {o["id"]: o for o in orders.data}
+                for row in index.data:
+                    order = orders_by_id.get(row["order_id"])
+                    if order:
+                        order_copy = order.copy()
+                        order_copy["products"] = row["items"]
+                        seller_orders.append(order_copy)
+            if limit is not None or len(index.data) < size:
+                break
+            start += size
         logger.info(f"Fetched {len(seller_orders)} orders for seller {session['email']}")
         return seller_orders
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error fetching seller orders for {session['email']}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching seller orders: {str(e)}")
 
+@app.get("/seller/analytics")
+async def get_seller_analytics(
+    bucket: str = "day",
+    date_from: date | None = None,
+    date_to: date | None = None,
+    product_id: str | None = None,
+    session: dict = Depends(get_session)
+):
+    try:
+        if bucket not in ["day", "week", "month"]:
+            raise HTTPException(status_code=400, detail="bucket must be day, week or month")
+        if product_id:
+            try:
+                uuid.UUID(product_id)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid product ID format")
+        # Grouped and totalled in SQL and returned as one value, so no row limit applies
+        result = supabase.rpc("seller_sales_series", {
+            "p_seller_id": session["user_id"],
+            "p_bucket": bucket,
+            "p_from": date_from.isoformat() if date_from else None,
+            "p_to": date_to.isoformat() if date_to else None,
+            "p_product_id": product_id
+        }).execute().data or {"series": [], "totals": {"revenue": 0, "units": 0, "orders": 0}}
+
+        logger.info(f"Fetched {len(result['series'])} analytics points for seller {session['email']}")
+        return {"bucket": bucket, "series": result["series"], "totals": result["totals"]}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Error fetching analytics for {session['email']}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error fetching analytics: {str(e)}")
+
 @app.put("/orders/{order_id}/status")
 async def update_order_status(order_id: str, status_update: OrderStatusUpdate, session: dict = Depends(get_session)):
     try:
@@ -1127,17 +2186,28 @@ async def update_order_status(order_id: str, status_update: OrderStatusUpdate, s
         if is_buyer and status_update.status == "Cancelled":
             if order.data["status"] not in ["Pending", "Processing"]:
                 raise HTTPException(status_code=403, detail="Order cannot be cancelled at this stage")
-            
-            # Restock products
+
+            # Restock every line and cancel the order in one transaction
+            result = supabase.rpc("cancel_order_with_restock", {
+                "p_order_id": order_id,
+                "p_buyer_id": session["user_id"]
+            }).execute().data
+            if not result or not result["ok"]:
+                raise HTTPException(status_code=403, detail="Order cannot be cancelled at this stage")
+            for stock in result["stock"]:
+                bump_catalog_version(stock["id"], stock["category"], stock["seller_id"])
+                facet_set_quantity(stock["id"], stock["quantity"])
+                match_set_stock(stock["id"], stock["quantity"])
+                logger.info(f"Restocked product {stock['id']}: new quantity {stock['quantity']}")
+            restocked_ids = {stock["id"] for stock in result["stock"]}
             for item in order.data["products"]:
-                product = supabase.table("products").select("quantity").eq("id", item["id"]).single().execute()
-                if product.data:
-                    new_quantity = product.data["quantity"] + item["quantity"]
-                    supabase.table("products").update({"quantity": new_quantity}).eq("id", item["id"]).execute()
-                    logger.info(f"Restocked product {item['id']}: new quantity {new_quantity}")
-                else:
+                if item["id"] not in restocked_ids:
                     logger.warning(f"Product {item['id']} not found for restocking")
 
+            publish_order_event(result["order"], "status")
+            logger.info(f"Order {order_id} status updated to Cancelled by {session['email']}")
+            return result["order"]
+
         # Handle seller status updates
         elif is_seller:
             # Validate status transition for sellers
@@ -1173,6 +2243,7 @@ async def update_order_status(order_id: str, status_update: OrderStatusUpdate, s
         if not response.data:
             raise HTTPException(status_code=500, detail="Failed to update order status")
 
+        publish_order_event(response.data[0], "status")
         logger.info(f"Order {order_id} status updated to {status_update.status} by {session['email']}")
         return response.data[0]
     except HTTPException as e:
@@ -1194,43 +2265,55 @@ async def update_order_details(
             logger.error(f"Invalid order_id format: {order_id}")
             raise HTTPException(status_code=400, detail="Invalid order ID format")
 
-        # Fetch order
-        order = supabase.table("orders").select("*").eq("id", order_id).single().execute()
-        if not order.data:
-            logger.error(f"Order not found: {order_id}")
-            raise HTTPException(status_code=404, detail="Order not found")
-
-        # Check if seller has products in the order
-        seller_products = [p for p in order.data["products"] if p.get("seller_id") == session["user_id"]]
-        if not seller_products:
-            logger.error(f"Seller {session['email']} has no products in order {order_id}")
-            raise HTTPException(status_code=403, detail="You don't have permission to update this order")
-
         # Validate details
         update_data = {
             "updated_at": datetime.utcnow().isoformat()
         }
+        delivery_method = None
         if "pickup_time" in details:
-            if order.data["delivery_method"] != "self_pickup":
-                raise HTTPException(status_code=400, detail="Pickup time only applicable for Self Pickup")
+            delivery_method = "self_pickup"
             try:
                 pickup_time = datetime.fromisoformat(details["pickup_time"].replace("Z", "+00:00"))
                 update_data["pickup_time"] = pickup_time.isoformat()
-            except ValueError:
+            except (ValueError, AttributeError):
                 raise HTTPException(status_code=400, detail="Invalid pickup time format")
         if "tracking_link" in details:
-            if order.data["delivery_method"] != "parcel":
+            if delivery_method == "self_pickup":
                 raise HTTPException(status_code=400, detail="Tracking link only applicable for Parcel")
+            delivery_method = "parcel"
             if not isinstance(details["tracking_link"], str) or len(details["tracking_link"]) > 500:
                 raise HTTPException(status_code=400, detail="Invalid tracking link")
             update_data["tracking_link"] = details["tracking_link"]
 
-        response = supabase.table("orders").update(update_data).eq("id", order_id).execute()
-        if not response.data:
-            raise HTTPException(status_code=500, detail="Failed to update order details")
+        # Seller ownership and delivery method are enforced by the update's filters;
+        # orders.products is jsonb (see schema_updates.sql), so cs is jsonb containment
+        query = supabase.table("orders").update(update_data).eq("id", order_id).filter(
+            "products", "cs", json.dumps([{"seller_id": session["user_id"]}])
+        )
+        if delivery_method:
+            query = query.eq("delivery_method", delivery_method)
+
+        def explain_miss(order: dict):
+            if not any(p.get("seller_id") == session["user_id"] for p in order["products"]):
+                logger.error(f"Seller {session['email']} has no products in order {order_id}")
+                raise HTTPException(status_code=403, detail="You don't have permission to update this order")
+            if "pickup_time" in details and order["delivery_method"] != "self_pickup":
+                raise HTTPException(status_code=400, detail="Pickup time only applicable for Self Pickup")
+            if "tracking_link" in details and order["delivery_method"] != "parcel":
+                raise HTTPException(status_code=400, detail="Tracking link only applicable for Parcel")
 
+        updated = mutate_or_raise(
+            query,
+            "orders",
+            order_id,
+            "Order not found",
+            "You don't have permission to update this order",
+            explain_miss
+        )
+
+        publish_order_event(updated[0], "details")
         logger.info(f"Order {order_id} details updated by {session['email']}")
-        return response.data[0]
+        return updated[0]
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -1261,12 +2344,127 @@ class NotificationFeedback(BaseModel):
     comment: Optional[str] = None
 
 
+EXPERT_FIELDS = ["id", "name", "email", "phone", "specialty", "experience_years", "languages", "language", "rating", "photo_url", "location", "created_at"]
+
+# Experts directory: an in-memory snapshot of the experts table, rebuilt after
+# EXPERTS_SNAPSHOT_TTL seconds or on demand, with token indexes on specialty and
+# location so filtered lookups only touch matching experts.
+EXPERTS_SNAPSHOT_TTL = int(os.getenv("EXPERTS_SNAPSHOT_TTL", 300))
+EXPERTS_MAX_AGE = int(os.getenv("EXPERTS_MAX_AGE", 60))
+
+EXPERTS_MIN_REFRESH_SECONDS = 30
+
+experts_directory = {
+    "experts": [], "by_id": {}, "by_specialty": {}, "by_location": {},
+    "specialty_tokens": [], "location_tokens": [], "loaded_at": 0.0, "expires": 0.0
+}
+
+def directory_tokens(value) -> set:
+    if isinstance(value, list):
+        value = " ".join(str(v) for v in value)
+    return {t for t in re.split(r"[^a-z0-9]+", str(value or "").lower()) if t}
+
+def refresh_experts_directory():
+    experts = []
+    page_size = 1000
+    offset = 0
+    while True:
+        page = supabase.table("experts").select("*").order("name").order("id").range(offset, offset + page_size - 1).execute()
+        experts.extend(page.data)
+        if len(page.data) < page_size:
+            break
+        offset += page_size
+    by_specialty: Dict[str, set] = {}
+    by_location: Dict[str, set] = {}
+    for position, expert in enumerate(experts):
+        for token in directory_tokens(expert.get("specialty")):
+            by_specialty.setdefault(token, set()).add(position)
+        for token in directory_tokens(expert.get("location")):
+            by_location.setdefault(token, set()).add(position)
+    experts_directory.update({
+        "experts": experts,
+        "by_id": {e["id"]: e for e in experts},
+        "by_specialty": by_specialty,
+        "by_location": by_location,
+        "specialty_tokens": sorted(by_specialty),
+        "location_tokens": sorted(by_location),
+        "loaded_at": time.time(),
+        "expires": time.time() + EXPERTS_SNAPSHOT_TTL
+    })
+    logger.info(f"Refreshed experts directory: {len(experts)} experts")
+
+def ensure_experts_directory():
+    if experts_directory["expires"] <= time.time():
+        refresh_experts_directory()
+
+def match_directory_index(field: str, text: str) -> set:
+    """Positions of experts with a field token starting with each token of text.
+
+    Prefix matches are a contiguous run of the sorted token list, found with bisect.
+    """
+    tokens = directory_tokens(text)
+    if not tokens:
+        return set(range(len(experts_directory["experts"])))
+    index = experts_directory[f"by_{field}"]
+    indexed = experts_directory[f"{field}_tokens"]
+    matches = None
+    for token in tokens:
+        positions = set()
+        i = bisect_left(indexed, token)
+        while i < len(indexed) and indexed[i].startswith(token):
+            positions |= index[indexed[i]]
+            i += 1
+        matches = positions if matches is None else matches & positions
+    return matches
+
 @app.get("/experts")
-async def get_experts():
+async def get_experts(
+    fields: str | None = None,
+    specialty: str | None = None,
+    location: str | None = None,
+    language: str | None = None,
+    min_rating: float | None = None,
+    q: str | None = None,
+    limit: int | None = None,
+    offset: int = 0,
+    if_none_match: Optional[str] = Header(None)
+):
     try:
-        response = supabase.table("experts").select("*").execute()
-        logger.info(f"Fetched {len(response.data)} experts")
-        return response.data
+        check_page(limit, offset, "exact")
+        requested = parse_fields(fields, EXPERT_FIELDS)
+        ensure_experts_directory()
+        experts = experts_directory["experts"]
+
+        positions = None
+        if specialty:
+            positions = match_directory_index("specialty", specialty)
+        if location:
+            found = match_directory_index("location", location)
+            positions = found if positions is None else positions & found
+        candidates = [experts[i] for i in sorted(positions)] if positions is not None else experts
+        if language:
+            wanted = language.lower()
+            candidates = [e for e in candidates if wanted in directory_tokens(e.get("languages")) | directory_tokens(e.get("language"))]
+        if min_rating is not None:
+            candidates = [e for e in candidates if (e.get("rating") or 0) >= min_rating]
+        if q:
+            needle = q.lower()
+            candidates = [e for e in candidates if any(needle in str(e.get(k) or "").lower() for k in ("name", "specialty", "location"))]
+
+        total = len(candidates)
+        page = candidates[offset:offset + limit] if limit is not None else candidates[offset:]
+        if requested != "*":
+            keys = requested.split(",")
+            page = [{k: e.get(k) for k in keys} for e in page]
+
+        body = json.dumps(jsonable_encoder(page), sort_keys=True, separators=(",", ":"))
+        entry = {"body": body, "etag": f'"{hashlib.md5(body.encode()).hexdigest()}"'}
+        response = catalog_response(entry, if_none_match, f"public, max-age={EXPERTS_MAX_AGE}")
+        response.headers["X-Total-Count"] = str(total)
+        logger.info(f"Fetched {len(page)} of {total} experts")
+        return response
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error fetching experts: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching experts: {str(e)}")
@@ -1274,8 +2472,18 @@ async def get_experts():
 @app.post("/appointment_requests")
 async def create_appointment_request(
     request_data: AppointmentRequestCreate,
+    idempotency_key: Optional[str] = Header(None),
     session: dict = Depends(get_current_session)
 ):
+    return await run_idempotent(
+        idempotency_key,
+        "appointment_requests",
+        session["user_id"],
+        request_data,
+        lambda: submit_appointment_request(request_data, session)
+    )
+
+async def submit_appointment_request(request_data: AppointmentRequestCreate, session: dict):
     try:
         # Verify expert exists
         expert = supabase.table("experts").select("id, name, email").eq("id", str(request_data.expert_id)).single().execute()
@@ -1391,6 +2599,7 @@ async def handle_appointment_request_action(action_data: AppointmentRequestActio
         if not notification_response.data:
             logger.error(f"Failed to create notification for appointment request: {request.data['id']}")
             raise HTTPException(status_code=500, detail="Failed to create notification")
+        notifications_created(notification_response.data)
 
         # Send email to farmer
         farmer_profile = supabase.table("profiles").select("email, first_name").eq("id", request.data["farmer_id"]).single().execute()
@@ -1446,41 +2655,146 @@ async def get_appointment_request(token: str):
         logger.error(f"Error fetching appointment request: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching request: {str(e)}")
 
-@app.get("/notifications")
-async def get_notifications(session: dict = Depends(get_current_session)):
-    try:
-        logger.info(f"Fetching notifications for user_id: {session['user_id']}, email: {session['email']}")
-        # Basic query without joins
-        response = supabase.table("notifications").select("*").eq("farmer_id", session["user_id"]).execute()
-        logger.info(f"Raw notifications response: {response.data}")
-        if not response.data:
-            logger.info(f"No notifications found for user_id: {session['user_id']}")
-            return []
-        notifications = []
-        for n in response.data:
-            # Fetch appointment request
-            ar_response = supabase.table("appointment_requests").select("*").eq("id", n["appointment_request_id"]).single().execute()
-            if not ar_response.data:
-                logger.warning(f"Appointment request {n['appointment_request_id']} not found for notification {n['id']}")
+UNKNOWN_EXPERT = {"name": "Unknown", "email": None, "phone": None}
+
+def get_expert_contacts(expert_ids: List[str]) -> Dict[str, dict]:
+    """Expert contact details for notifications, read from the experts directory snapshot."""
+    if not expert_ids:
+        return {}
+    ensure_experts_directory()
+    missing = any(eid not in experts_directory["by_id"] for eid in expert_ids)
+    if missing and time.time() - experts_directory["loaded_at"] > EXPERTS_MIN_REFRESH_SECONDS:
+        # Possibly an expert added since the last snapshot
+        refresh_experts_directory()
+    contacts = {}
+    for eid in expert_ids:
+        expert = experts_directory["by_id"].get(eid)
+        contacts[eid] = {k: expert.get(k) for k in ("name", "email", "phone")} if expert else UNKNOWN_EXPERT
+    return contacts
+
+def assemble_notifications(rows: List[dict]) -> List[dict]:
+    """Render notification rows for the dashboard with at most two lookups plus cached experts."""
+    appointment_ids = list({n["appointment_request_id"] for n in rows if n["type"] != "request_match" and n.get("appointment_request_id")})
+    wanted_ids = list({n["wanted_product_id"] for n in rows if n["type"] == "request_match" and n.get("wanted_product_id")})
+    appointments = {}
+    if appointment_ids:
+        response = supabase.table("appointment_requests").select("id, full_name, reason, issue, decline_reason, expert_id").in_("id", appointment_ids).execute()
+        appointments = {ar["id"]: ar for ar in response.data}
+    wanted_by_id = {}
+    if wanted_ids:
+        response = supabase.table("user_wanted_products").select("id, product_name, quantity, unit, deliveryLocation, requiredDateTime").in_("id", wanted_ids).execute()
+        wanted_by_id = {w["id"]: w for w in response.data}
+    experts = get_expert_contacts([ar["expert_id"] for ar in appointments.values() if ar.get("expert_id")])
+
+    notifications = []
+    for n in rows:
+        if n["type"] == "request_match":
+            # Buyer request routed to this farmer by the demand matcher
+            w = wanted_by_id.get(n["wanted_product_id"])
+            if not w:
                 continue
-            ar = ar_response.data
-            # Fetch expert
-            expert_response = supabase.table("experts").select("name, email, phone").eq("id", ar["expert_id"]).single().execute()
-            expert = expert_response.data if expert_response.data else {"name": "Unknown", "email": None, "phone": None}
             notifications.append({
                 "id": n["id"],
-                "farmerName": ar["full_name"],
-                "query": ar["reason"],
-                "description": ar["issue"],
+                "query": w["product_name"],
+                "description": f"{w['quantity']} {w['unit']} needed" + (f" at {w['deliveryLocation']}" if w["deliveryLocation"] else ""),
                 "status": n["status"],
-                "expertName": expert["name"],
-                "expertEmail": expert["email"] if n["status"] == "confirmed" else None,
-                "expertPhone": expert["phone"] if n["status"] == "confirmed" else None,
-                "declineReason": ar["decline_reason"],
+                "wantedProductId": w["id"],
+                "deadline": w["requiredDateTime"],
                 "timestamp": n["created_at"],
-                "type": n["type"],
-                "feedback": {"rating": n["feedback_rating"], "comment": n["feedback_comment"]}
+                "updatedAt": n["updated_at"],
+                "read": n.get("read_at") is not None,
+                "type": n["type"]
             })
+            continue
+        ar = appointments.get(n["appointment_request_id"])
+        if not ar:
+            logger.warning(f"Appointment request {n['appointment_request_id']} not found for notification {n['id']}")
+            continue
+        expert = experts.get(ar["expert_id"], UNKNOWN_EXPERT)
+        notifications.append({
+            "id": n["id"],
+            "farmerName": ar["full_name"],
+            "query": ar["reason"],
+            "description": ar["issue"],
+            "status": n["status"],
+            "expertName": expert["name"],
+            "expertEmail": expert["email"] if n["status"] == "confirmed" else None,
+            "expertPhone": expert["phone"] if n["status"] == "confirmed" else None,
+            "declineReason": ar["decline_reason"],
+            "timestamp": n["created_at"],
+            "updatedAt": n["updated_at"],
+            "read": n.get("read_at") is not None,
+            "type": n["type"],
+            "feedback": {"rating": n["feedback_rating"], "comment": n["feedback_comment"]}
+        })
+    return notifications
+
+# Unread notification counts per user, loaded with one count query and then kept
+# current by the notification write paths. Entries are reloaded after UNREAD_COUNT_TTL
+# because cascaded deletes (archived wanted products) bypass those paths.
+UNREAD_COUNT_TTL = int(os.getenv("UNREAD_COUNT_TTL", 300))
+
+unread_counts: Dict[str, dict] = {}
+
+def get_unread_count(user_id: str) -> int:
+    entry = unread_counts.get(user_id)
+    if entry is None or entry["expires"] <= time.time():
+        result = supabase.table("notifications").select("id", count="exact").eq("farmer_id", user_id).is_("read_at", "null").limit(1).execute()
+        entry = {"count": result.count or 0, "expires": time.time() + UNREAD_COUNT_TTL}
+        unread_counts[user_id] = entry
+    return entry["count"]
+
+def adjust_unread_count(user_id: str, delta: int):
+    entry = unread_counts.get(user_id)
+    if entry is None or not delta:
+        return
+    entry["count"] = max(0, entry["count"] + delta)
+    publish_event("notification", [user_id], {"type": "unread", "count": entry["count"]})
+
+def notifications_created(rows: List[dict], rendered: Optional[List[dict]] = None):
+    for farmer_id, created in Counter(row["farmer_id"] for row in rows).items():
+        adjust_unread_count(farmer_id, created)
+    publish_notifications(rows, "created", rendered)
+
+def publish_notifications(rows: List[dict], event_type: str, rendered: Optional[List[dict]] = None):
+    """Push created or updated notifications to their farmers' notification streams.
+
+    Callers that already rendered the rows off the event loop pass them as `rendered`.
+    """
+    if rendered is None:
+        rendered = assemble_notifications(rows)
+    rendered = {n["id"]: n for n in rendered}
+    for row in rows:
+        if row["id"] in rendered:
+            publish_event("notification", [row["farmer_id"]], {"type": event_type, "notification": rendered[row["id"]]})
+
+@app.get("/notifications/events")
+async def stream_notification_events(request: Request, session: dict = Depends(get_stream_session)):
+    logger.info(f"Notification event stream opened for {session['email']}")
+    return event_stream_response(request, "notification", session["user_id"])
+
+@app.get("/notifications/count")
+async def get_notification_count(session: dict = Depends(get_current_session)):
+    try:
+        return {"unread": get_unread_count(session["user_id"])}
+    except Exception as e:
+        logger.error(f"Error counting notifications for {session['email']}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error counting notifications: {str(e)}")
+
+@app.get("/notifications")
+async def get_notifications(since: datetime | None = None, session: dict = Depends(get_current_session)):
+    try:
+        logger.info(f"Fetching notifications for user_id: {session['user_id']}, email: {session['email']}")
+        query = supabase.table("notifications").select("*").eq("farmer_id", session["user_id"])
+        if since:
+            # Incremental sync: only notifications created or changed after the client's last updatedAt
+            response = query.gt("updated_at", since.isoformat()).order("updated_at").execute()
+        else:
+            response = query.order("created_at").execute()
+        if not response.data:
+            logger.info(f"No notifications found for user_id: {session['user_id']}")
+            return []
+        notifications = assemble_notifications(response.data)
         logger.info(f"Fetched {len(notifications)} notifications for {session['email']}")
         return notifications
     except Exception as e:
@@ -1508,10 +2822,15 @@ async def submit_notification_feedback(
             "status": "feedbackProvided",
             "updated_at": datetime.utcnow().isoformat()
         }
+        if notification.data.get("read_at") is None:
+            update_data["read_at"] = update_data["updated_at"]
         response = supabase.table("notifications").update(update_data).eq("id", str(notification_id)).execute()
         if not response.data:
             logger.error(f"Failed to submit feedback for notification: {notification_id}")
             raise HTTPException(status_code=500, detail="Failed to submit feedback")
+        if notification.data.get("read_at") is None:
+            adjust_unread_count(session["user_id"], -1)
+        publish_notifications(response.data, "updated")
         logger.info(f"Feedback submitted for notification {notification_id} by {session['email']}")
         return {"message": "Feedback submitted successfully"}
     except HTTPException as e:
@@ -1520,6 +2839,37 @@ async def submit_notification_feedback(
         logger.error(f"Error submitting feedback for {session['email']}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error submitting feedback: {str(e)}")
 
+@app.post("/notifications/read-all")
+async def mark_all_notifications_read(session: dict = Depends(get_current_session)):
+    try:
+        now = datetime.utcnow().isoformat()
+        response = supabase.table("notifications").update({"read_at": now, "updated_at": now}).eq("farmer_id", session["user_id"]).is_("read_at", "null").execute()
+        adjust_unread_count(session["user_id"], -len(response.data))
+        logger.info(f"Marked {len(response.data)} notifications read for {session['email']}")
+        return {"marked": len(response.data)}
+    except Exception as e:
+        logger.error(f"Error marking notifications read for {session['email']}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error marking notifications read: {str(e)}")
+
+@app.post("/notifications/{notification_id}/read")
+async def mark_notification_read(notification_id: UUID, session: dict = Depends(get_current_session)):
+    try:
+        now = datetime.utcnow().isoformat()
+        response = supabase.table("notifications").update({"read_at": now, "updated_at": now}).eq("id", str(notification_id)).eq("farmer_id", session["user_id"]).is_("read_at", "null").execute()
+        if response.data:
+            adjust_unread_count(session["user_id"], -1)
+            publish_notifications(response.data, "updated")
+        else:
+            existing = supabase.table("notifications").select("id").eq("id", str(notification_id)).eq("farmer_id", session["user_id"]).execute()
+            if not existing.data:
+                raise HTTPException(status_code=404, detail="Notification not found or not authorized")
+        return {"message": "Notification marked as read"}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Error marking notification read for {session['email']}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error marking notification read: {str(e)}")
+
 @app.delete("/notifications/{notification_id}")
 async def delete_notification(notification_id: UUID, session: dict = Depends(get_current_session)):
     try:
@@ -1527,6 +2877,9 @@ async def delete_notification(notification_id: UUID, session: dict = Depends(get
         if not response.data:
             logger.error(f"Notification not found or not authorized: {notification_id}")
             raise HTTPException(status_code=404, detail="Notification not found or not authorized")
+        if response.data[0].get("read_at") is None:
+            adjust_unread_count(session["user_id"], -1)
+        publish_event("notification", [session["user_id"]], {"type": "deleted", "id": str(notification_id)})
         logger.info(f"Notification {notification_id} deleted by {session['email']}")
         return {"message": "Notification deleted successfully"}
     except HTTPException as e:
@@ -1693,7 +3046,10 @@ async def verify_otp(request: VerifyOtpRequest):
         raise HTTPException(status_code=500, detail=f"Error verifying OTP: {error_detail}")
 
 @app.post("/wanted-products", response_model=WantedProductResponse)
-async def add_wanted_product(product: WantedProduct, session: dict = Depends(get_current_session)):
+async def add_wanted_product(product: WantedProduct, idempotency_key: Optional[str] = Header(None), session: dict = Depends(get_current_session)):
+    return await run_idempotent(idempotency_key, "wanted-products", session["user_id"], product, lambda: insert_wanted_product(product, session))
+
+async def insert_wanted_product(product: WantedProduct, session: dict):
     try:
         if product.quantity <= 0:
             raise HTTPException(status_code=400, detail="Quantity must be positive")
@@ -1721,9 +3077,15 @@ async def add_wanted_product(product: WantedProduct, session: dict = Depends(get
             "created_at": datetime.utcnow().isoformat(),
             "updated_at": datetime.utcnow().isoformat()
         }
+        point = geo_utils.geocode(product.deliveryLocation)
+        if not point:
+            buyer = supabase.table("buyers").select("location").eq("id", session["user_id"]).execute()
+            point = geo_utils.geocode(buyer.data[0]["location"]) if buyer.data else None
+        product_data["latitude"], product_data["longitude"] = point or (None, None)
         response = supabase.table("user_wanted_products").insert(product_data).execute()
         if not response.data:
             raise HTTPException(status_code=500, detail="Failed to add wanted product")
+        schedule_wanted_routing(response.data[0])
 
         logger.info(f"Wanted product added by {session['email']}: {product_data['product_name']}")
         return response.data[0]
@@ -1733,12 +3095,20 @@ async def add_wanted_product(product: WantedProduct, session: dict = Depends(get
         logger.error(f"Error adding wanted product for {session['email']}: {str(e)}")
         raise HTTPException(status_code=500, detail="Error adding wanted product")
 
+WANTED_PRODUCT_FIELDS = ["id", "user_id", "product_name", "category", "quantity", "unit", "notes", "deliveryLocation", "requiredDateTime", "created_at", "updated_at"]
+
 @app.get("/wanted-products", response_model=List[WantedProductResponse])
-async def get_wanted_products(session: dict = Depends(get_current_session)):
+async def get_wanted_products(fields: str | None = None, session: dict = Depends(get_current_session)):
     try:
-        response = supabase.table("user_wanted_products").select("*").eq("user_id", session["user_id"]).execute()
+        select_fields = parse_fields(fields, WANTED_PRODUCT_FIELDS)
+        response = supabase.table("user_wanted_products").select(select_fields).eq("user_id", session["user_id"]).execute()
         logger.info(f"Fetched {len(response.data)} wanted products for {session['email']}")
+        if fields:
+            # Partial rows would fail WantedProductResponse validation
+            return JSONResponse(content=response.data)
         return response.data
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error fetching wanted products for {session['email']}: {str(e)}")
         raise HTTPException(status_code=500, detail="Error fetching wanted products")
@@ -1756,7 +3126,6 @@ async def delete_wanted_product(product_id: str, session: dict = Depends(get_cur
         if not response.data:
             logger.error(f"Wanted product not found: {product_id}")
             raise HTTPException(status_code=404, detail="Wanted product not found")
-
         logger.info(f"Wanted product {product_id} deleted by {session['email']}")
         return {"message": "Wanted product deleted successfully"}
     except HTTPException as e:
@@ -1785,12 +3154,15 @@ async def complete_profile(request: CompleteProfileRequest, session: dict = Depe
         buyer_response = supabase.table("buyers").select("*").eq("id", session["user_id"]).execute()
         logger.info(f"Buyer query response: {buyer_response.data}")
 
+        latitude, longitude = geo_utils.geocode(request.location.strip()) or (None, None)
         buyer_data = {
             "id": session["user_id"],
             "email": request.email,
             "first_name": request.full_name,
             "phoneNumber": request.phoneNumber,
             "location": request.location.strip(),
+            "latitude": latitude,
+            "longitude": longitude,
             "updated_at": datetime.utcnow().isoformat()
         }
 
@@ -1799,6 +3171,8 @@ async def complete_profile(request: CompleteProfileRequest, session: dict = Depe
                 "first_name": request.full_name,
                 "phoneNumber": request.phoneNumber,
                 "location": request.location.strip(),
+                "latitude": latitude,
+                "longitude": longitude,
                 "updated_at": datetime.utcnow().isoformat()
             }).eq("id", session["user_id"]).execute()
             if not update_response.data:
@@ -1826,81 +3200,463 @@ async def complete_profile(request: CompleteProfileRequest, session: dict = Depe
         raise HTTPException(status_code=500, detail=f"Error completing profile: {error_detail}")
     
 
-@app.get("/farmer/wanted-products")
-async def get_wanted_products(session: dict = Depends(get_current_session)):
+FEED_PAGE_SIZE = 50
+# Rows per PostgREST read when the whole feed is requested, below the default max-rows
+FEED_FULL_BATCH_SIZE = 999
+FEED_MAX_SCANS = 3
+
+def encode_feed_cursor(row: dict) -> str:
+    raw = json.dumps([row.get("requiredDateTime"), row["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def parse_deadline(value: str) -> datetime:
+    """Parse a requiredDateTime value as naive UTC, the form used for stored timestamps."""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def apply_feed_cursor(query, cursor: Optional[str], floor: Optional[datetime] = None):
+    """Continue after the cursor row in (requiredDateTime asc nulls last, id) order.
+
+    Rows with a deadline before floor sort first, so skipping them only moves
+    the start of the scan forward.
+    """
+    if cursor:
+        try:
+            deadline, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if deadline is None:
+            return query.is_("requiredDateTime", "null").gt("id", last_id)
+        if floor is None or parse_deadline(deadline) >= floor:
+            return query.or_(
+                f'requiredDateTime.gt."{deadline}",'
+                f'and(requiredDateTime.eq."{deadline}",id.gt.{last_id}),'
+                f'requiredDateTime.is.null'
+            )
+    if floor is None:
+        return query
+    return query.or_(f'requiredDateTime.gte."{floor.isoformat()}",requiredDateTime.is.null')
+
+# Background expiry: past-deadline wanted products are moved to the archive table in
+# batches by the expire_wanted_products RPC; counts are kept for GET /metrics.
+WANTED_EXPIRY_INTERVAL_SECONDS = int(os.getenv("WANTED_EXPIRY_INTERVAL_SECONDS", 300))
+WANTED_EXPIRY_BATCH_SIZE = int(os.getenv("WANTED_EXPIRY_BATCH_SIZE", 500))
+
+expiry_metrics = {
+    "runs": 0,
+    "failures": 0,
+    "expired_total": 0,
+    "last_expired": 0,
+    "last_run_at": None,
+    "last_duration_ms": None,
+    "last_error": None
+}
+expiry_task: Optional[asyncio.Task] = None
+
+def expire_wanted_products() -> tuple:
+    """Archive expired requests in batches; runs in a worker thread.
+
+    Returns (archived ids, error) so the caller can record what was archived even
+    when a later batch failed.
+    """
+    archived = []
+    try:
+        while True:
+            ids = supabase.rpc("expire_wanted_products", {"p_batch_size": WANTED_EXPIRY_BATCH_SIZE}).execute().data or []
+            archived.extend(ids)
+            if len(ids) < WANTED_EXPIRY_BATCH_SIZE:
+                break
+    except Exception as e:
+        return archived, e
+    return archived, None
+
+async def wanted_expiry_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = time.perf_counter()
+        archived, error = await loop.run_in_executor(None, expire_wanted_products)
+        expiry_metrics["runs"] += 1
+        expiry_metrics["expired_total"] += len(archived)
+        expiry_metrics["last_expired"] = len(archived)
+        expiry_metrics["last_run_at"] = datetime.utcnow().isoformat()
+        expiry_metrics["last_duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        if error:
+            expiry_metrics["failures"] += 1
+            expiry_metrics["last_error"] = type(error).__name__
+            logger.error(f"Error expiring wanted products: {str(error)}")
+        else:
+            expiry_metrics["last_error"] = None
+        if archived:
+            logger.info(f"Archived {len(archived)} expired wanted products")
+        await asyncio.sleep(WANTED_EXPIRY_INTERVAL_SECONDS)
+
+@app.get("/metrics")
+async def get_metrics(session: dict = Depends(get_session)):
+    return {"wanted_product_expiry": expiry_metrics}
+
+# Demand summary: wanted products pre-grouped in the database by product, category,
+# base unit, grid cell and deadline week, refreshed in the background so the
+# endpoint only filters and sums these rows. Only deadlines from
+# DEMAND_SUMMARY_WINDOW_DAYS ago onwards are grouped. A refresh interval of 0
+# refreshes on every request instead of in the background.
+DEMAND_SUMMARY_REFRESH_SECONDS = int(os.getenv("DEMAND_SUMMARY_REFRESH_SECONDS", 600))
+DEMAND_SUMMARY_WINDOW_DAYS = int(os.getenv("DEMAND_SUMMARY_WINDOW_DAYS", 28))
+DEMAND_CELL_DEG = 0.5
+
+demand_summary = {"rows": [], "refreshed_at": None}
+demand_summary_task: Optional[asyncio.Task] = None
+
+def refresh_demand_summary():
+    global demand_summary
+    window_start = date.today() - timedelta(days=DEMAND_SUMMARY_WINDOW_DAYS)
+    rows = supabase.rpc("wanted_demand_rollup", {
+        "p_cell_deg": DEMAND_CELL_DEG,
+        "p_from": window_start.isoformat()
+    }).execute().data or []
+    for row in rows:
+        row["week"] = date.fromisoformat(row["week"]) if row["week"] else None
+        if row["cell_lat"] is not None and row["cell_lon"] is not None:
+            center = ((row["cell_lat"] + 0.5) * DEMAND_CELL_DEG, (row["cell_lon"] + 0.5) * DEMAND_CELL_DEG)
+            row["center"] = center
+            row["location"] = geo_utils.nearest_place(*center)
+        else:
+            row["center"] = None
+            row["location"] = None
+    # Swapped in whole so readers never see a half-built snapshot
+    demand_summary = {"rows": rows, "refreshed_at": datetime.utcnow().isoformat()}
+    logger.info(f"Refreshed demand summary: {len(rows)} groups")
+
+async def demand_summary_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, refresh_demand_summary)
+        except Exception as e:
+            logger.error(f"Error refreshing demand summary: {str(e)}")
+        await asyncio.sleep(DEMAND_SUMMARY_REFRESH_SECONDS)
+
+async def current_demand_summary() -> dict:
+    """Return the demand snapshot, refreshing it first when there is none yet or when
+    background refresh is off. A failed refresh serves the last good snapshot."""
+    if DEMAND_SUMMARY_REFRESH_SECONDS <= 0 or demand_summary["refreshed_at"] is None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, refresh_demand_summary)
+        except Exception as e:
+            logger.error(f"Error refreshing demand summary: {str(e)}")
+            if demand_summary["refreshed_at"] is None:
+                raise HTTPException(status_code=503, detail="Demand summary is not available yet")
+    return demand_summary
+
+@app.get("/farmer/demand-summary")
+async def get_demand_summary(
+    product: str | None = None,
+    category: str | None = None,
+    near: str | None = None,
+    radius_km: float = 50,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    by_location: bool = True,
+    session: dict = Depends(get_current_session)
+):
     try:
         profile = supabase.table("profiles").select("category").eq("id", session["user_id"]).single().execute()
         if not profile.data or profile.data["category"] != "Farmer":
             logger.error(f"User {session['email']} is not a farmer")
             raise HTTPException(status_code=403, detail="Access denied: Farmers only")
+        origin = None
+        if near:
+            origin = geo_utils.geocode(near)
+            if not origin:
+                raise HTTPException(status_code=400, detail=f"Unknown location: {near}")
+            if radius_km <= 0 or radius_km > 1000:
+                raise HTTPException(status_code=400, detail="radius_km must be between 0 and 1000")
+        snapshot = await current_demand_summary()
+
+        # Rows are bucketed by deadline week, so a date range keeps every week it overlaps
+        week_from = date_from - timedelta(days=date_from.weekday()) if date_from else None
+        product_filter = product.strip().lower() if product else None
+        groups: Dict[tuple, dict] = {}
+        for row in snapshot["rows"]:
+            if product_filter and product_filter not in row["product_name"]:
+                continue
+            if category and row["category"] != category:
+                continue
+            if (date_from or date_to) and row["week"] is None:
+                continue
+            if week_from and row["week"] < week_from:
+                continue
+            if date_to and row["week"] > date_to:
+                continue
+            # Cells are matched by their centre, so the radius is effectively widened by half a cell
+            if origin and (row["center"] is None or geo_utils.haversine_km(*origin, *row["center"]) > radius_km + DEMAND_CELL_DEG * 55):
+                continue
+            key = (row["product_name"], row["category"], row["unit"], row["location"] if by_location else None)
+            group = groups.setdefault(key, {
+                "product_name": row["product_name"],
+                "category": row["category"],
+                "unit": row["unit"],
+                "location": key[3],
+                "quantity": 0.0,
+                "requests": 0
+            })
+            group["quantity"] += float(row["quantity"])
+            group["requests"] += row["requests"]
+
+        summary = sorted(groups.values(), key=lambda g: -g["quantity"])
+        for group in summary:
+            group["quantity"] = round(group["quantity"], 2)
+        logger.info(f"Demand summary for {session['email']}: {len(summary)} groups")
+        return {"refreshed_at": snapshot["refreshed_at"], "groups": summary}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Error fetching demand summary for {session['email']}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error fetching demand summary: {str(e)}")
+
+# Per-farmer ignored request ids, loaded on first use and written through on ignore.
+# Ids are UUID strings, so a plain set gives the O(1) membership test the feed needs.
+IGNORED_CACHE_MAX_FARMERS = int(os.getenv("IGNORED_CACHE_MAX_FARMERS", 10000))
+IGNORE_BATCH_LIMIT = 500
+
+ignored_sets: Dict[str, set] = {}
+
+def get_ignored_set(farmer_id: str) -> set:
+    ignored = ignored_sets.pop(farmer_id, None)
+    if ignored is None:
+        ignored = set()
+        page_size = 1000
+        offset = 0
+        while True:
+            page = supabase.table("ignored_requests").select("wanted_product_id").eq("farmer_id", farmer_id).range(offset, offset + page_size - 1).execute()
+            ignored.update(row["wanted_product_id"] for row in page.data)
+            if len(page.data) < page_size:
+                break
+            offset += page_size
+        while len(ignored_sets) >= IGNORED_CACHE_MAX_FARMERS:
+            ignored_sets.pop(next(iter(ignored_sets)))
+    # Reinsert so eviction drops the least recently used farmer
+    ignored_sets[farmer_id] = ignored
+    return ignored
+
+def ignore_requests(farmer_id: str, product_ids: List[str]) -> List[str]:
+    """Record ignores for existing requests, skipping ones already ignored; returns the new ids."""
+    ignored = get_ignored_set(farmer_id)
+    pending = [pid for pid in dict.fromkeys(product_ids) if pid not in ignored]
+    if not pending:
+        return []
+    existing = supabase.table("user_wanted_products").select("id").in_("id", pending).execute()
+    new_ids = [row["id"] for row in existing.data]
+    if new_ids:
+        now = datetime.utcnow().isoformat()
+        supabase.table("ignored_requests").upsert(
+            [{"farmer_id": farmer_id, "wanted_product_id": pid, "created_at": now} for pid in new_ids],
+            on_conflict="farmer_id,wanted_product_id",
+            ignore_duplicates=True
+        ).execute()
+        ignored.update(new_ids)
+    return new_ids
 
-        # Fetch wanted products, excluding ignored requests
-        response = supabase.table("user_wanted_products").select("*, buyers(first_name, email, phoneNumber, location)").execute()
-        if not response.data:
-            logger.info(f"No wanted products found for {session['email']}")
-            return []
-
-        # Filter out ignored requests
-        ignored = supabase.table("ignored_requests").select("wanted_product_id").eq("farmer_id", session["user_id"]).execute()
-        ignored_ids = [item["wanted_product_id"] for item in ignored.data]
-        filtered_data = [item for item in response.data if item["id"] not in ignored_ids]
+@app.get("/farmer/wanted-products")
+async def get_wanted_products(
+    response: Response,
+    category: str | None = None,
+    location: str | None = None,
+    due_after: datetime | None = None,
+    due_before: datetime | None = None,
+    near: str | None = None,
+    radius_km: float = 50,
+    matched: bool = False,
+    include_expired: bool = False,
+    cursor: str | None = None,
+    limit: int | None = None,
+    session: dict = Depends(get_current_session)
+):
+    try:
+        origin = parse_near(near, radius_km)
+        check_page(limit, 0, "exact")
+        # Without cursor or limit the whole feed is returned, as existing clients expect
+        page_size = limit if limit is not None else (FEED_PAGE_SIZE if cursor else None)
+        profile = supabase.table("profiles").select("category").eq("id", session["user_id"]).single().execute()
+        if not profile.data or profile.data["category"] != "Farmer":
+            logger.error(f"User {session['email']} is not a farmer")
+            raise HTTPException(status_code=403, detail="Access denied: Farmers only")
 
-        logger.info(f"Fetched {len(filtered_data)} wanted products for {session['email']}")
-        return filtered_data
+        distances = {}
+
+        def feed_query(after: Optional[str]):
+            # Anti-join: embed this farmer's ignore rows and keep only requests without one
+            select_fields = "*, buyers(first_name, email, phoneNumber, location), ignored_requests!left(farmer_id)"
+            if matched:
+                # Only requests the matcher routed to this farmer
+                select_fields += ", farmer_feed!inner(score)"
+            query = supabase.table("user_wanted_products").select(select_fields).eq(
+                "ignored_requests.farmer_id", session["user_id"]
+            ).is_("ignored_requests", "null")
+            if matched:
+                query = query.eq("farmer_feed.farmer_id", session["user_id"])
+            if category:
+                query = query.eq("category", category)
+            if location:
+                query = query.ilike("deliveryLocation", f"%{location}%")
+            if due_after:
+                query = query.gte("requiredDateTime", due_after.isoformat())
+            if due_before:
+                query = query.lte("requiredDateTime", due_before.isoformat())
+            if origin:
+                # A fixed-size box filter; rows in its corners are dropped by distance below
+                min_lat, max_lat, min_lon, max_lon = geo_utils.bounding_box(origin[0], origin[1], radius_km)
+                query = query.gte("latitude", min_lat).lte("latitude", max_lat).gte("longitude", min_lon).lte("longitude", max_lon)
+            query = apply_feed_cursor(query, after, None if include_expired else floor)
+            return query.order("requiredDateTime", nullsfirst=False).order("id")
+
+        # Past-deadline requests are hidden unless asked for; the expiry job archives them
+        floor = datetime.utcnow()
+        # The database already excludes ignored requests; the cached set also drops ones
+        # ignored by a concurrent request, and near= drops rows outside the radius. A page left short after FEED_MAX_SCANS reads
+        # still returns a cursor, so one request never chains unbounded round trips.
+        ignored = get_ignored_set(session["user_id"])
+        scans = 0
+        batch_size = page_size or FEED_FULL_BATCH_SIZE
+        feed = []
+        scan_cursor = cursor
+        has_more = True
+        while has_more and (page_size is None or (len(feed) < page_size and scans < FEED_MAX_SCANS)):
+            scans += 1
+            batch = feed_query(scan_cursor).limit(batch_size + 1).execute().data
+            has_more = len(batch) > batch_size
+            for item in batch:
+                if item["id"] in ignored:
+                    continue
+                if origin:
+                    distance = geo_utils.haversine_km(origin[0], origin[1], item["latitude"], item["longitude"])
+                    if distance > radius_km:
+                        continue
+                    distances[item["id"]] = distance
+                if page_size is not None and len(feed) == page_size:
+                    has_more = True
+                    break
+                feed.append(item)
+            if batch:
+                scan_cursor = encode_feed_cursor(batch[-1])
+
+        for item in feed:
+            item.pop("ignored_requests", None)
+            if matched:
+                item["match_score"] = item.pop("farmer_feed")[0]["score"]
+            if origin:
+                item["distance_km"] = round(distances[item["id"]], 1)
+        if page_size is not None and has_more:
+            # Resume after the last returned row, or after the last scanned row when the page stopped short
+            next_cursor = encode_feed_cursor(feed[-1]) if len(feed) == page_size else scan_cursor
+            if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
+
+        logger.info(f"Fetched {len(feed)} wanted products for {session['email']}")
+        return feed
     except HTTPException as e:
         raise e
     except Exception as e:
         logger.error(f"Error fetching wanted products for {session['email']}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching wanted products: {str(e)}")
 
+class IgnoreRequestsBatch(BaseModel):
+    product_ids: List[str]
 
-# Existing /farmer/accept-request/{product_id} endpoint (unchanged, included for completeness)
-class AcceptRequest(BaseModel):
-    farmer_contact: str
-
-@app.post("/farmer/accept-request/{product_id}")
-async def accept_request(product_id: str, request: AcceptRequest, session: dict = Depends(get_current_session)):
+@app.post("/farmer/ignore-request/{product_id}")
+async def ignore_request(product_id: str, session: dict = Depends(get_current_session)):
     try:
-        logger.info(f"Processing accept request for product_id: {product_id}, user: {session['email']}, contact: {request.farmer_contact}")
-        # Validate farmer profile
         profile = supabase.table("profiles").select("category").eq("id", session["user_id"]).single().execute()
         if not profile.data or profile.data["category"] != "Farmer":
             logger.error(f"User {session['email']} is not a farmer")
             raise HTTPException(status_code=403, detail="Access denied: Farmers only")
+        try:
+            uuid.UUID(product_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid request ID format")
 
-        # Check if request exists
-        wanted_product = supabase.table("user_wanted_products").select("user_id").eq("id", product_id).single().execute()
-        if not wanted_product.data:
+        if not ignore_requests(session["user_id"], [product_id]) and product_id not in get_ignored_set(session["user_id"]):
             logger.error(f"Request {product_id} not found")
             raise HTTPException(status_code=404, detail="Request not found")
 
-        # Check if request is already completed
-        completed = supabase.table("accepted_requests").select("id").eq("wanted_product_id", product_id).eq("status", "Completed").execute()
-        if completed.data:
-            logger.warning(f"Request {product_id} is already completed")
-            raise HTTPException(status_code=400, detail="Request is already completed")
+        logger.info(f"Request {product_id} ignored by farmer {session['email']}")
+        return {"message": "Request ignored successfully"}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Error ignoring request {product_id} for {session['email']}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error ignoring request: {str(e)}")
+
+@app.post("/farmer/ignore-requests")
+async def ignore_requests_batch(batch: IgnoreRequestsBatch, session: dict = Depends(get_current_session)):
+    try:
+        profile = supabase.table("profiles").select("category").eq("id", session["user_id"]).single().execute()
+        if not profile.data or profile.data["category"] != "Farmer":
+            logger.error(f"User {session['email']} is not a farmer")
+            raise HTTPException(status_code=403, detail="Access denied: Farmers only")
+        if not batch.product_ids:
+            raise HTTPException(status_code=400, detail="product_ids must not be empty")
+        if len(batch.product_ids) > IGNORE_BATCH_LIMIT:
+            raise HTTPException(status_code=400, detail=f"At most {IGNORE_BATCH_LIMIT} requests per batch")
+        for product_id in batch.product_ids:
+            try:
+                uuid.UUID(product_id)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid request ID format: {product_id}")
+
+        ignored = ignore_requests(session["user_id"], batch.product_ids)
+        logger.info(f"{len(ignored)} requests ignored by farmer {session['email']}")
+        return {"ignored": ignored, "count": len(ignored)}
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Error ignoring requests for {session['email']}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error ignoring requests: {str(e)}")
+
+
+# Typed failures returned by the request workflow RPCs; the code is echoed in X-Error-Code
+REQUEST_WORKFLOW_ERRORS = {
+    "not_farmer": (403, "Access denied: Farmers only"),
+    "not_found": (404, "Request not found"),
+    "forbidden": (403, "Not authorized"),
+    "completed": (409, "Request is already completed"),
+    "already_accepted": (409, "Request already accepted by you")
+}
+
+def run_request_workflow(function: str, params: dict) -> dict:
+    result = supabase.rpc(function, params).execute().data
+    if not result:
+        raise HTTPException(status_code=500, detail=f"{function} returned no result")
+    if not result["ok"]:
+        status_code, detail = REQUEST_WORKFLOW_ERRORS[result["error"]]
+        raise HTTPException(status_code=status_code, detail=detail, headers={"X-Error-Code": result["error"]})
+    return result["request"]
 
-        # Check for existing acceptance by this farmer
-        existing = supabase.table("accepted_requests").select("id").eq("wanted_product_id", product_id).eq("farmer_id", session["user_id"]).execute()
-        if existing.data:
-            logger.warning(f"Request {product_id} already accepted by {session['email']}")
-            raise HTTPException(status_code=400, detail="Request already accepted by you")
+class AcceptRequest(BaseModel):
+    farmer_contact: str
 
-        # Insert accepted request
-        response = supabase.table("accepted_requests").insert({
-            "id": str(uuid.uuid4()),
-            "wanted_product_id": product_id,
-            "farmer_id": session["user_id"],
-            "buyer_id": wanted_product.data["user_id"],
-            "farmer_contact": request.farmer_contact,
-            "created_at": datetime.utcnow().isoformat(),
-            "status": "Pending"
-        }).execute()
-        logger.debug(f"Insert response: {response.data}")
+@app.post("/farmer/accept-request/{product_id}")
+async def accept_request(product_id: str, request: AcceptRequest, session: dict = Depends(get_current_session)):
+    try:
+        logger.info(f"Processing accept request for product_id: {product_id}, user: {session['email']}, contact: {request.farmer_contact}")
+        try:
+            uuid.UUID(product_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid request ID format")
+
+        # Role check, existence, completion check and insert run in one transaction
+        accepted = run_request_workflow("accept_wanted_request", {
+            "p_wanted_product_id": product_id,
+            "p_farmer_id": session["user_id"],
+            "p_farmer_contact": request.farmer_contact
+        })
+        logger.debug(f"Accepted request: {accepted}")
 
         logger.info(f"Request {product_id} accepted by farmer {session['email']}")
         return {"message": "Request accepted successfully"}
     except HTTPException as e:
+        logger.warning(f"Accept request {product_id} by {session['email']} failed: {e.detail}")
         raise e
     except Exception as e:
         logger.error(f"Error accepting request {product_id} for {session['email']}: {str(e)}")
@@ -1939,33 +3695,22 @@ async def get_accepted_requests(session: dict = Depends(get_current_session)):
 async def mark_request_completed(request_id: str, session: dict = Depends(get_current_session)):
     try:
         logger.info(f"Marking request {request_id} as completed for buyer: {session['email']}")
-        # Verify request exists and belongs to buyer
-        request = supabase.table("accepted_requests").select("buyer_id, status, wanted_product_id").eq("id", request_id).single().execute()
-        if not request.data:
-            logger.error(f"Request {request_id} not found")
-            raise HTTPException(status_code=404, detail="Request not found")
-        if request.data["buyer_id"] != session["user_id"]:
-            logger.error(f"Buyer {session['email']} not authorized for request {request_id}")
-            raise HTTPException(status_code=403, detail="Not authorized")
-        if request.data["status"] == "Completed":
-            logger.warning(f"Request {request_id} already completed")
-            raise HTTPException(status_code=400, detail="Request already completed")
-
-        # Update status to Completed
-        response = supabase.table("accepted_requests").update({
-            "status": "Completed",
-            "updated_at": datetime.utcnow().isoformat()
-        }).eq("id", request_id).execute()
-        logger.debug(f"Update response: {response.data}")
+        try:
+            uuid.UUID(request_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid request ID format")
 
-        # Delete the wanted product
-        product_id = request.data["wanted_product_id"]
-        delete_response = supabase.table("user_wanted_products").delete().eq("id", product_id).eq("user_id", session["user_id"]).execute()
-        logger.debug(f"Delete wanted product response: {delete_response.data}")
+        # Completes the request and deletes the wanted product in one transaction
+        completed = run_request_workflow("complete_wanted_request", {
+            "p_request_id": request_id,
+            "p_buyer_id": session["user_id"]
+        })
+        product_id = completed["wanted_product_id"]
 
         logger.info(f"Request {request_id} marked as completed and product {product_id} deleted by buyer {session['email']}")
         return {"message": "Request marked as completed and product removed"}
     except HTTPException as e:
+        logger.warning(f"Completing request {request_id} by {session['email']} failed: {e.detail}")
         raise e
     except Exception as e:
         logger.error(f"Error marking request {request_id} as completed for {session['email']}: {str(e)}")
@@ -1975,32 +3720,27 @@ async def mark_request_completed(request_id: str, session: dict = Depends(get_cu
 async def reject_request(request_id: str, session: dict = Depends(get_current_session)):
     try:
         logger.info(f"Rejecting request {request_id} for buyer: {session['email']}")
-        # Verify request exists and belongs to buyer
-        request = supabase.table("accepted_requests").select("buyer_id, status").eq("id", request_id).single().execute()
-        if not request.data:
-            logger.error(f"Request {request_id} not found")
-            raise HTTPException(status_code=404, detail="Request not found")
-        if request.data["buyer_id"] != session["user_id"]:
-            logger.error(f"Buyer {session['email']} not authorized for request {request_id}")
-            raise HTTPException(status_code=403, detail="Not authorized")
-        if request.data["status"] == "Completed":
-            logger.warning(f"Request {request_id} is already completed")
-            raise HTTPException(status_code=400, detail="Cannot reject a completed request")
+        try:
+            uuid.UUID(request_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid request ID format")
 
-        # Delete the accepted request
-        response = supabase.table("accepted_requests").delete().eq("id", request_id).execute()
-        logger.debug(f"Delete response: {response.data}")
+        # Ownership and status are checked under a row lock before the delete
+        run_request_workflow("reject_wanted_request", {
+            "p_request_id": request_id,
+            "p_buyer_id": session["user_id"]
+        })
 
         logger.info(f"Request {request_id} rejected by buyer {session['email']}")
         return {"message": "Request rejected successfully"}
     except HTTPException as e:
+        logger.warning(f"Rejecting request {request_id} by {session['email']} failed: {e.detail}")
         raise e
     except Exception as e:
         logger.error(f"Error rejecting request {request_id} for {session['email']}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error rejecting request: {str(e)}")
 
 
-
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
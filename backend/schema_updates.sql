@@ -0,0 +1,590 @@
+-- Schema changes required by the backend, applied in order in the Supabase SQL editor.
+
+-- orders.products must be jsonb: the statements below expand it with jsonb_array_elements
+-- and PUT /orders/{id}/details filters it with jsonb containment (cs). Convert it if an
+-- older project created it as json or text.
+do $$
+begin
+    if (select data_type from information_schema.columns
+         where table_schema = 'public' and table_name = 'orders' and column_name = 'products') <> 'jsonb' then
+        alter table orders alter column products type jsonb using products::jsonb;
+    end if;
+end;
+$$;
+
+-- Geocoded coordinates for proximity search (GET /products?near=, GET /farmer/wanted-products?near=)
+alter table user_wanted_products
+    add column if not exists latitude double precision,
+    add column if not exists longitude double precision;
+alter table buyers
+    add column if not exists latitude double precision,
+    add column if not exists longitude double precision;
+alter table farmer_details
+    add column if not exists latitude double precision,
+    add column if not exists longitude double precision;
+
+-- Normalized order lines, indexed by seller, so seller views do not scan every order
+create table if not exists order_items (
+    id bigserial primary key,
+    order_id uuid not null references orders(id) on delete cascade,
+    seller_id uuid not null,
+    product_id uuid not null,
+    name text,
+    qty numeric not null,
+    price numeric not null,
+    created_at timestamptz not null default now()
+);
+create index if not exists order_items_seller_created_idx on order_items (seller_id, created_at desc);
+create index if not exists order_items_order_idx on order_items (order_id);
+
+-- One row per (seller, order) with that seller's lines in the orders.products shape,
+-- plus the order columns /seller/orders filters on, so those filters are pushed down.
+create or replace view seller_order_index as
+select i.seller_id,
+       i.order_id,
+       o.created_at::timestamptz as created_at,
+       jsonb_agg(jsonb_build_object(
+           'id', i.product_id,
+           'name', i.name,
+           'quantity', i.qty,
+           'price', i.price,
+           'seller_id', i.seller_id) order by i.id) as items,
+       o.status,
+       o.delivery_method,
+       o.total_price
+  from order_items i
+  join orders o on o.id = i.order_id
+ group by i.seller_id, i.order_id, o.created_at, o.status, o.delivery_method, o.total_price;
+
+-- Backfill order_items from existing orders
+insert into order_items (order_id, seller_id, product_id, name, qty, price, created_at)
+select o.id, (p->>'seller_id')::uuid, (p->>'id')::uuid, p->>'name', (p->>'quantity')::numeric, (p->>'price')::numeric, o.created_at::timestamptz
+  from orders o
+ cross join jsonb_array_elements(o.products) p
+ where p->>'seller_id' is not null
+   and not exists (select 1 from order_items i where i.order_id = o.id);
+
+-- Atomic stock reservation for POST /orders: locks the ordered products, reports
+-- shortfalls without changing anything, otherwise decrements all of them and
+-- inserts the order and its order_items rows in the same transaction.
+create or replace function create_order_with_reservation(p_order jsonb, p_items jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_shortfalls jsonb;
+    v_stock jsonb;
+    v_order orders;
+begin
+    create temporary table if not exists _order_lines (id uuid primary key, qty numeric) on commit drop;
+    truncate _order_lines;
+    insert into _order_lines (id, qty)
+    select (e->>'id')::uuid, sum((e->>'quantity')::numeric)
+    from jsonb_array_elements(p_items) e
+    group by 1;
+
+    -- Lock in id order so concurrent checkouts cannot deadlock
+    perform 1 from products p join _order_lines l on l.id = p.id order by p.id for update of p;
+
+    select coalesce(jsonb_agg(jsonb_build_object(
+               'id', l.id,
+               'requested', l.qty,
+               'available', coalesce(p.quantity, 0))), '[]'::jsonb)
+      into v_shortfalls
+      from _order_lines l
+      left join products p on p.id = l.id
+     where p.id is null or p.quantity < l.qty;
+
+    if jsonb_array_length(v_shortfalls) > 0 then
+        return jsonb_build_object('ok', false, 'shortfalls', v_shortfalls);
+    end if;
+
+    with updated as (
+        update products p
+           set quantity = p.quantity - l.qty,
+               updated_at = now()
+          from _order_lines l
+         where p.id = l.id and p.quantity >= l.qty
+        returning p.id, p.quantity
+    )
+    select jsonb_agg(jsonb_build_object('id', id, 'quantity', quantity)) into v_stock from updated;
+
+    insert into orders
+    select * from jsonb_populate_record(null::orders, p_order)
+    returning * into v_order;
+
+    insert into order_items (order_id, seller_id, product_id, name, qty, price, created_at)
+    select v_order.id, (p->>'seller_id')::uuid, (p->>'id')::uuid, p->>'name', (p->>'quantity')::numeric, (p->>'price')::numeric, v_order.created_at::timestamptz
+      from jsonb_array_elements(v_order.products) p
+     where p->>'seller_id' is not null;
+
+    return jsonb_build_object('ok', true, 'order', to_jsonb(v_order), 'stock', v_stock);
+end;
+$$;
+
+-- Buyer cancellation for PUT /orders/{id}/status: cancels the order only while it is
+-- still Pending/Processing and restocks every line with one update, in one transaction.
+-- Product rows are locked in id order first, as create_order_with_reservation does, so a
+-- cancel and a checkout cannot deadlock.
+create or replace function cancel_order_with_restock(p_order_id uuid, p_buyer_id uuid)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_order orders;
+    v_stock jsonb;
+begin
+    select * into v_order
+      from orders
+     where id = p_order_id and buyer_id = p_buyer_id
+       for update;
+
+    if not found or v_order.status not in ('Pending', 'Processing') then
+        return jsonb_build_object('ok', false);
+    end if;
+
+    perform 1
+       from products
+      where id = any(array(select distinct (p->>'id')::uuid from jsonb_array_elements(v_order.products) p))
+      order by id
+        for update;
+
+    with lines as (
+        select (p->>'id')::uuid as id, sum((p->>'quantity')::numeric) as qty
+          from jsonb_array_elements(v_order.products) p
+         group by 1
+    ), updated as (
+        update products pr
+           set quantity = pr.quantity + l.qty,
+               updated_at = now()
+          from lines l
+         where pr.id = l.id
+        returning pr.id, pr.quantity, pr.category, pr.seller_id
+    )
+    select coalesce(jsonb_agg(jsonb_build_object(
+               'id', id, 'quantity', quantity, 'category', category, 'seller_id', seller_id)), '[]'::jsonb)
+      into v_stock
+      from updated;
+
+    update orders
+       set status = 'Cancelled',
+           updated_at = now()
+     where id = p_order_id
+    returning * into v_order;
+
+    return jsonb_build_object('ok', true, 'order', to_jsonb(v_order), 'stock', v_stock);
+end;
+$$;
+
+-- Per seller, product and day sales rollups for /seller/analytics, maintained by a
+-- trigger on orders: +1 on insert, -1 when an order moves to Cancelled.
+-- backfill_sales_rollups.py rebuilds the table from existing orders.
+create table if not exists seller_sales_daily (
+    seller_id uuid not null,
+    product_id uuid not null,
+    day date not null,
+    revenue numeric not null default 0,
+    units numeric not null default 0,
+    orders integer not null default 0,
+    primary key (seller_id, product_id, day)
+);
+
+create or replace function apply_sales_rollup(p_order orders, p_sign integer)
+returns void
+language sql
+as $$
+    insert into seller_sales_daily as r (seller_id, product_id, day, revenue, units, orders)
+    select (p->>'seller_id')::uuid,
+           (p->>'id')::uuid,
+           (p_order.created_at::timestamptz at time zone 'UTC')::date,
+           p_sign * sum((p->>'price')::numeric * (p->>'quantity')::numeric),
+           p_sign * sum((p->>'quantity')::numeric),
+           p_sign
+      from jsonb_array_elements(p_order.products) p
+     where p->>'seller_id' is not null
+     group by 1, 2, 3
+    on conflict (seller_id, product_id, day) do update
+       set revenue = r.revenue + excluded.revenue,
+           units = r.units + excluded.units,
+           orders = r.orders + excluded.orders;
+$$;
+
+create or replace function orders_sales_rollup_trigger()
+returns trigger
+language plpgsql
+as $$
+begin
+    if tg_op = 'INSERT' and new.status <> 'Cancelled' then
+        perform apply_sales_rollup(new, 1);
+    elsif tg_op = 'UPDATE' and new.status = 'Cancelled' and old.status <> 'Cancelled' then
+        perform apply_sales_rollup(old, -1);
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists orders_sales_rollup on orders;
+create trigger orders_sales_rollup
+after insert or update of status on orders
+for each row execute function orders_sales_rollup_trigger();
+
+-- Farmer request feed (GET /farmer/wanted-products): keyset order and the ignored-requests anti-join
+create index if not exists user_wanted_products_deadline_idx on user_wanted_products ("requiredDateTime", id);
+create index if not exists user_wanted_products_category_idx on user_wanted_products (category);
+create unique index if not exists ignored_requests_farmer_product_idx on ignored_requests (farmer_id, wanted_product_id);
+create index if not exists ignored_requests_product_idx on ignored_requests (wanted_product_id);
+
+-- Demand matching: per-farmer feed entries written when a buyer request is routed
+create table if not exists farmer_feed (
+    farmer_id uuid not null,
+    wanted_product_id uuid not null references user_wanted_products(id) on delete cascade,
+    score numeric not null,
+    distance_km numeric,
+    created_at timestamptz not null default now(),
+    primary key (farmer_id, wanted_product_id)
+);
+create index if not exists farmer_feed_product_idx on farmer_feed (wanted_product_id);
+
+-- Request-match notifications point at the wanted product instead of an appointment
+alter table notifications
+    add column if not exists wanted_product_id uuid references user_wanted_products(id) on delete cascade;
+alter table notifications alter column appointment_request_id drop not null;
+
+-- Buyer request workflow (accept / complete / reject), one transactional call per step.
+-- Each function returns {ok: true, ...} or {ok: false, error: <code>}.
+-- Existing duplicates would make the unique indexes below fail to build: keep one row per
+-- (request, farmer), preferring a completed one, then one completion per request (the earliest).
+delete from accepted_requests a
+ using (
+    select id, row_number() over (
+               partition by wanted_product_id, farmer_id
+               order by (status = 'Completed') desc, created_at, id) as rn
+      from accepted_requests
+ ) d
+ where a.id = d.id and d.rn > 1;
+delete from accepted_requests a
+ using (
+    select id, row_number() over (partition by wanted_product_id order by created_at, id) as rn
+      from accepted_requests
+     where status = 'Completed'
+ ) d
+ where a.id = d.id and d.rn > 1;
+create unique index if not exists accepted_requests_product_farmer_idx on accepted_requests (wanted_product_id, farmer_id);
+create unique index if not exists accepted_requests_completed_idx on accepted_requests (wanted_product_id) where status = 'Completed';
+
+create or replace function accept_wanted_request(p_wanted_product_id uuid, p_farmer_id uuid, p_farmer_contact text)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_buyer_id uuid;
+    v_request accepted_requests;
+begin
+    if not exists (select 1 from profiles where id = p_farmer_id and category = 'Farmer') then
+        return jsonb_build_object('ok', false, 'error', 'not_farmer');
+    end if;
+
+    -- Lock the wanted product so a concurrent completion cannot slip in between the checks
+    select user_id into v_buyer_id
+      from user_wanted_products
+     where id = p_wanted_product_id
+       for share;
+    if not found then
+        return jsonb_build_object('ok', false, 'error', 'not_found');
+    end if;
+
+    if exists (select 1 from accepted_requests where wanted_product_id = p_wanted_product_id and status = 'Completed') then
+        return jsonb_build_object('ok', false, 'error', 'completed');
+    end if;
+
+    insert into accepted_requests (id, wanted_product_id, farmer_id, buyer_id, farmer_contact, created_at, status)
+    values (gen_random_uuid(), p_wanted_product_id, p_farmer_id, v_buyer_id, p_farmer_contact, now(), 'Pending')
+    on conflict (wanted_product_id, farmer_id) do nothing
+    returning * into v_request;
+    if not found then
+        return jsonb_build_object('ok', false, 'error', 'already_accepted');
+    end if;
+
+    return jsonb_build_object('ok', true, 'request', to_jsonb(v_request));
+end;
+$$;
+
+-- Two completions of the same request can both pass the status check; the loser hits
+-- accepted_requests_completed_idx and gets the typed 'completed' error instead of a 500.
+create or replace function complete_wanted_request(p_request_id uuid, p_buyer_id uuid)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_request accepted_requests;
+begin
+    select * into v_request
+      from accepted_requests
+     where id = p_request_id
+       for update;
+    if not found then
+        return jsonb_build_object('ok', false, 'error', 'not_found');
+    end if;
+    if v_request.buyer_id <> p_buyer_id then
+        return jsonb_build_object('ok', false, 'error', 'forbidden');
+    end if;
+    if v_request.status = 'Completed' then
+        return jsonb_build_object('ok', false, 'error', 'completed');
+    end if;
+
+    begin
+        update accepted_requests
+           set status = 'Completed',
+               updated_at = now()
+         where id = p_request_id
+        returning * into v_request;
+    exception when unique_violation then
+        return jsonb_build_object('ok', false, 'error', 'completed');
+    end;
+
+    delete from user_wanted_products
+     where id = v_request.wanted_product_id and user_id = p_buyer_id;
+
+    return jsonb_build_object('ok', true, 'request', to_jsonb(v_request));
+end;
+$$;
+
+create or replace function reject_wanted_request(p_request_id uuid, p_buyer_id uuid)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_request accepted_requests;
+begin
+    select * into v_request
+      from accepted_requests
+     where id = p_request_id
+       for update;
+    if not found then
+        return jsonb_build_object('ok', false, 'error', 'not_found');
+    end if;
+    if v_request.buyer_id <> p_buyer_id then
+        return jsonb_build_object('ok', false, 'error', 'forbidden');
+    end if;
+    if v_request.status = 'Completed' then
+        return jsonb_build_object('ok', false, 'error', 'completed');
+    end if;
+
+    delete from accepted_requests where id = p_request_id;
+
+    return jsonb_build_object('ok', true, 'request', to_jsonb(v_request));
+end;
+$$;
+
+-- Expiry of past-deadline wanted products: rows move to an archive table in batches.
+-- Requests with an open (not Completed) acceptance are kept so the buyer can still finish them.
+create table if not exists user_wanted_products_archive (like user_wanted_products including defaults);
+alter table user_wanted_products_archive add column if not exists archived_at timestamptz not null default now();
+
+create or replace function expire_wanted_products(p_batch_size integer)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_ids jsonb;
+begin
+    with expired as (
+        select w.id
+          from user_wanted_products w
+         where w."requiredDateTime"::timestamp < (now() at time zone 'utc')
+           and not exists (
+               select 1 from accepted_requests a
+                where a.wanted_product_id = w.id and a.status <> 'Completed')
+         order by w."requiredDateTime"
+         limit p_batch_size
+           for update skip locked
+    ), moved as (
+        delete from user_wanted_products w
+         using expired e
+         where w.id = e.id
+        returning w.*
+    ), archived as (
+        insert into user_wanted_products_archive
+        select m.*, now() from moved m
+        returning id
+    )
+    select coalesce(jsonb_agg(id), '[]'::jsonb) into v_ids from archived;
+    return v_ids;
+end;
+$$;
+
+-- Demand summary source (GET /farmer/demand-summary): wanted products with deadlines from
+-- p_from's week on, grouped by normalized product name, category, base unit (g counted as
+-- kg), grid cell and deadline week. The groups come back as one jsonb array, so PostgREST
+-- max-rows never truncates them.
+create or replace function wanted_demand_rollup(p_cell_deg double precision, p_from date)
+returns jsonb
+language sql
+stable
+as $$
+    select coalesce(jsonb_agg(to_jsonb(g)), '[]'::jsonb)
+      from (
+        select lower(trim(w.product_name)) as product_name,
+               w.category,
+               case when w.unit = 'g' then 'kg' else w.unit end as unit,
+               floor(w.latitude / p_cell_deg)::integer as cell_lat,
+               floor(w.longitude / p_cell_deg)::integer as cell_lon,
+               date_trunc('week', w."requiredDateTime"::timestamp)::date as week,
+               sum(case when w.unit = 'g' then w.quantity / 1000 else w.quantity end) as quantity,
+               count(*) as requests
+          from user_wanted_products w
+         where w."requiredDateTime"::timestamp >= date_trunc('week', p_from)
+         group by 1, 2, 3, 4, 5, 6
+      ) g;
+$$;
+
+-- Notification read state, unread counts and incremental sync (GET /notifications?since=)
+alter table notifications add column if not exists read_at timestamptz;
+create index if not exists notifications_farmer_updated_idx on notifications (farmer_id, updated_at);
+create index if not exists notifications_farmer_unread_idx on notifications (farmer_id) where read_at is null;
+
+-- PATCH /products/batch: apply partial updates in one statement. Only keys present in
+-- each patch are written, and only existing rows owned by the seller are touched.
+create or replace function apply_product_patches(p_seller_id uuid, p_patches jsonb)
+returns setof products
+language sql
+as $$
+    update products p
+       set name        = case when x.patch ? 'name'        then x.patch->>'name'                 else p.name end,
+           category    = case when x.patch ? 'category'    then x.patch->>'category'             else p.category end,
+           quantity    = case when x.patch ? 'quantity'    then (x.patch->>'quantity')::numeric  else p.quantity end,
+           unit        = case when x.patch ? 'unit'        then x.patch->>'unit'                 else p.unit end,
+           price       = case when x.patch ? 'price'       then (x.patch->>'price')::numeric     else p.price end,
+           description = case when x.patch ? 'description' then x.patch->>'description'          else p.description end,
+           image       = case when x.patch ? 'image'       then x.patch->>'image'                else p.image end,
+           updated_at  = now()
+      from jsonb_array_elements(p_patches) as x(patch)
+     where p.id = (x.patch->>'id')::uuid
+       and p.seller_id = p_seller_id
+    returning p.*;
+$$;
+
+-- PUT /products/{id}: full update of one owned product in one statement, returning the
+-- new row plus the category it had before, so both category listings can be invalidated.
+create or replace function update_product_returning_previous(p_product_id uuid, p_seller_id uuid, p_product jsonb)
+returns setof jsonb
+language sql
+as $$
+    with previous as (
+        select id, category
+          from products
+         where id = p_product_id and seller_id = p_seller_id
+           for update
+    )
+    update products p
+       set name        = p_product->>'name',
+           category    = p_product->>'category',
+           quantity    = (p_product->>'quantity')::numeric,
+           unit        = p_product->>'unit',
+           price       = (p_product->>'price')::numeric,
+           description = p_product->>'description',
+           image       = case when p_product ? 'image' then p_product->>'image' else p.image end,
+           updated_at  = now()
+      from previous
+     where p.id = previous.id
+    returning to_jsonb(p.*) || jsonb_build_object('previous_category', previous.category);
+$$;
+
+-- GET /seller/analytics: bucketed series and totals computed in the database and
+-- returned as one jsonb value, so PostgREST max-rows never truncates the result.
+create or replace function seller_sales_series(
+    p_seller_id uuid,
+    p_bucket text,
+    p_from date default null,
+    p_to date default null,
+    p_product_id uuid default null
+)
+returns jsonb
+language sql
+stable
+as $$
+    with rows as (
+        select product_id,
+               date_trunc(p_bucket, day)::date as period,
+               revenue, units, orders
+          from seller_sales_daily
+         where seller_id = p_seller_id
+           and (p_from is null or day >= date_trunc(p_bucket, p_from)::date)
+           and (p_to is null or day <= p_to)
+           and (p_product_id is null or product_id = p_product_id)
+    ), series as (
+        select product_id, period, sum(revenue) as revenue, sum(units) as units, sum(orders) as orders
+          from rows
+         group by product_id, period
+    )
+    select jsonb_build_object(
+        'series', coalesce((
+            select jsonb_agg(jsonb_build_object(
+                       'product_id', s.product_id,
+                       'product_name', pr.name,
+                       'period', s.period,
+                       'revenue', s.revenue,
+                       'units', s.units,
+                       'orders', s.orders) order by s.period, s.product_id)
+              from series s
+              left join products pr on pr.id = s.product_id), '[]'::jsonb),
+        'totals', (
+            select jsonb_build_object(
+                       'revenue', coalesce(sum(revenue), 0),
+                       'units', coalesce(sum(units), 0),
+                       'orders', coalesce(sum(orders), 0))
+              from rows));
+$$;
+
+-- Rebuild seller_sales_daily for a window of days with the same arithmetic as
+-- apply_sales_rollup. Existing rows in the window are replaced, so stale rows go away.
+-- Order writes are blocked for the duration so the trigger cannot interleave.
+create or replace function rebuild_seller_sales_daily(p_from date, p_to date)
+returns integer
+language plpgsql
+as $$
+declare
+    v_rows integer;
+begin
+    lock table orders in share mode;
+
+    delete from seller_sales_daily where day between p_from and p_to;
+
+    insert into seller_sales_daily (seller_id, product_id, day, revenue, units, orders)
+    select (p->>'seller_id')::uuid,
+           (p->>'id')::uuid,
+           (o.created_at::timestamptz at time zone 'UTC')::date,
+           sum((p->>'price')::numeric * (p->>'quantity')::numeric),
+           sum((p->>'quantity')::numeric),
+           count(distinct o.id)
+      from orders o
+     cross join jsonb_array_elements(o.products) p
+     where o.status <> 'Cancelled'
+       and p->>'seller_id' is not null
+       and (o.created_at::timestamptz at time zone 'UTC')::date between p_from and p_to
+     group by 1, 2, 3;
+    get diagnostics v_rows = row_count;
+    return v_rows;
+end;
+$$;
+
+-- GET /farmer/wanted-products?near= filters wanted products by a lat/lon bounding box
+create index if not exists user_wanted_products_lat_lon_idx on user_wanted_products (latitude, longitude);
+
+-- backfill_wanted_coordinates.py: set coordinates on many wanted products in one statement,
+-- only where none are stored yet. p_points is [{id, latitude, longitude}, ...].
+create or replace function set_wanted_product_coordinates(p_points jsonb)
+returns integer
+language sql
+as $$
+    with updated as (
+        update user_wanted_products w
+           set latitude = (x.point->>'latitude')::double precision,
+               longitude = (x.point->>'longitude')::double precision
+          from jsonb_array_elements(p_points) as x(point)
+         where w.id = (x.point->>'id')::uuid
+           and w.latitude is null
+        returning w.id
+    )
+    select count(*)::integer from updated;
+$$;
@@ -0,0 +1,80 @@
+"""Notification assembly must make the same number of round trips for any page size.
+
+main1 is imported with a fake Supabase client that counts execute() calls, so no
+network is used; the test is skipped when the backend's dependencies are missing.
+"""
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("supabase")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_KEY", "test.test.test")
+
+import main1
+
+class FakeQuery:
+    """Chainable stand-in for a PostgREST query; every filter returns the same query."""
+
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        self.client.executes += 1
+        return SimpleNamespace(data=self.client.tables.get(self.table, []), count=None)
+
+class FakeSupabase:
+    def __init__(self, tables):
+        self.tables = tables
+        self.executes = 0
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+def build_tables(n: int):
+    experts = [{"id": f"expert-{i}", "name": f"Expert {i}", "email": f"e{i}@example.com", "phone": "1",
+                "specialty": "Soil", "location": "Chennai"} for i in range(10)]
+    appointments = [{"id": f"ar-{i}", "full_name": "Farmer", "reason": "Pests", "issue": "Leaves",
+                     "decline_reason": None, "expert_id": f"expert-{i % 10}"} for i in range(n)]
+    wanted = [{"id": f"w-{i}", "product_name": "Tomato", "quantity": 10, "unit": "kg",
+               "deliveryLocation": "Madurai", "requiredDateTime": "2026-11-01T00:00:00"} for i in range(n)]
+    rows = []
+    for i in range(n):
+        common = {"status": "confirmed", "created_at": "2026-10-01T00:00:00", "updated_at": "2026-10-01T00:00:00",
+                  "read_at": None, "feedback_rating": None, "feedback_comment": None}
+        rows.append({**common, "id": f"n-a{i}", "type": "appointment", "appointment_request_id": f"ar-{i}"})
+        rows.append({**common, "id": f"n-w{i}", "type": "request_match", "wanted_product_id": f"w-{i}"})
+    tables = {"experts": experts, "appointment_requests": appointments, "user_wanted_products": wanted}
+    return tables, rows
+
+@pytest.fixture
+def fake_supabase(monkeypatch):
+    def install(tables):
+        client = FakeSupabase(tables)
+        monkeypatch.setattr(main1, "supabase", client)
+        main1.refresh_experts_directory()
+        client.executes = 0
+        return client
+    monkeypatch.setattr(main1, "experts_directory", dict(main1.experts_directory))
+    return install
+
+@pytest.mark.parametrize("n", [1, 10, 200])
+def test_assembly_round_trips_are_constant(fake_supabase, n):
+    tables, rows = build_tables(n)
+    client = fake_supabase(tables)
+
+    notifications = main1.assemble_notifications(rows)
+
+    assert len(notifications) == 2 * n
+    # One appointment_requests lookup and one user_wanted_products lookup; experts come from the snapshot
+    assert client.executes == 2
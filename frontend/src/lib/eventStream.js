@@ -0,0 +1,56 @@
+const API_URL = 'http://localhost:8000';
+
+const fetchStreamToken = async () => {
+  const response = await fetch(`${API_URL}/events/token`, {
+    method: 'POST',
+    headers: { 'X-Session-ID': localStorage.getItem('session_id') },
+  });
+  if (!response.ok) {
+    throw new Error(`Failed to open event stream: ${response.status}`);
+  }
+  return (await response.json()).token;
+};
+
+// Opens an SSE stream with a short-lived, single-use token instead of the session ID,
+// so the session never appears in a URL. Stream tokens cannot be replayed, so when the
+// browser's own reconnect is refused a fresh token is fetched and the stream resumes
+// from the last event it saw. `listeners` maps event names to handlers; `onOpen` runs
+// on every (re)connection. Returns a function that closes the stream.
+export const openEventStream = (path, listeners, { onOpen } = {}) => {
+  let source = null;
+  let lastEventId = null;
+  let closed = false;
+
+  const connect = async () => {
+    let token;
+    try {
+      token = await fetchStreamToken();
+    } catch (err) {
+      console.error('Event stream error:', err);
+      if (!closed) setTimeout(connect, 5000);
+      return;
+    }
+    if (closed) return;
+    const params = new URLSearchParams({ token });
+    if (lastEventId) params.set('last_event_id', lastEventId);
+    source = new EventSource(`${API_URL}${path}?${params}`);
+    if (onOpen) source.addEventListener('open', onOpen);
+    Object.entries(listeners).forEach(([name, handler]) => {
+      source.addEventListener(name, (event) => {
+        if (event.lastEventId) lastEventId = event.lastEventId;
+        handler(event);
+      });
+    });
+    source.addEventListener('error', () => {
+      if (source.readyState === EventSource.CLOSED && !closed) {
+        setTimeout(connect, 1000);
+      }
+    });
+  };
+
+  connect();
+  return () => {
+    closed = true;
+    if (source) source.close();
+  };
+};
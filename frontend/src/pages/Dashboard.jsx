@@ -93,8 +93,13 @@ const Dashboard = () => {
 
     loadNotifications();
 
-    // Poll notifications every 5 seconds
-    const interval = setInterval(loadNotifications, 5000);
+    // Reload only when another tab changes the stored notifications
+    const handleStorage = (event) => {
+      if (event.key === 'notifications') {
+        loadNotifications();
+      }
+    };
+    window.addEventListener('storage', handleStorage);
     window.history.pushState(null, null, window.location.href);
     const handlePopState = () => {
       window.history.pushState(null, null, window.location.href);
@@ -102,7 +107,7 @@ const Dashboard = () => {
     window.addEventListener('popstate', handlePopState);
 
     return () => {
-      clearInterval(interval);
+      window.removeEventListener('storage', handleStorage);
       window.removeEventListener('popstate', handlePopState);
     };
   }, [navigate, toast]);
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useNavigate } from 'react-router-dom';
 import Sidebar from '@/components/Sidebar';
 import { CheckCircle, MapPin, Truck, ArrowLeft, CreditCard, ShoppingBag } from 'lucide-react';
@@ -48,6 +48,8 @@ const Billing = () => {
   const [cart, setCart] = useState([]);
   const [deliveryInfo, setDeliveryInfo] = useState(null);
   const [paymentMethod, setPaymentMethod] = useState('upi');
+  // Reused across retries of this checkout so the server places the order only once
+  const orderKey = useRef(crypto.randomUUID());
   const [isLoading, setIsLoading] = useState(false);
   const [errors, setErrors] = useState({});
   const [expandedSection, setExpandedSection] = useState(null);
@@ -164,7 +166,10 @@ const Billing = () => {
         tracking_link: null,
       };
       const response = await axios.post('http://localhost:8000/orders', order, {
-        headers: { 'X-Session-ID': localStorage.getItem('session_id') },
+        headers: {
+          'X-Session-ID': localStorage.getItem('session_id'),
+          'Idempotency-Key': orderKey.current,
+        },
       });
       localStorage.removeItem('cart');
       localStorage.removeItem('delivery');
@@ -177,7 +182,7 @@ const Billing = () => {
       console.error('Place order error:', e);
       toast({
         title: 'Error',
-        description: e.response?.data?.detail || e.message || 'Failed to place order',
+        description: e.response?.data?.detail?.message || e.response?.data?.detail || e.message || 'Failed to place order',
         variant: 'destructive',
       });
       if (e.response?.status === 401) navigate('/login');
@@ -12,6 +12,7 @@ import { Textarea } from '@/components/ui/textarea';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
 import { Tooltip, TooltipContent, TooltipProvider, TooltipTrigger } from '@radix-ui/react-tooltip';
 import { useToast } from '@/hooks/use-toast';
+import { openEventStream } from '@/lib/eventStream';
 import axios from 'axios';
 
 // Progress Tracker Component for Order Status
@@ -101,6 +102,30 @@ const ManageProducts = () => {
     },
   };
 
+  useEffect(() => {
+    return openEventStream('/orders/events', {
+      order: (event) => {
+        const update = JSON.parse(event.data);
+        setProductOrders((prev) =>
+          prev.map((o) =>
+            o.id === update.order_id
+              ? {
+                  ...o,
+                  status: update.status,
+                  pickup_time: update.pickup_time,
+                  tracking_link: update.tracking_link,
+                  updated_at: update.updated_at,
+                }
+              : o
+          )
+        );
+        setOrderStatus((prev) =>
+          update.order_id in prev ? { ...prev, [update.order_id]: update.status } : prev
+        );
+      },
+    });
+  }, []);
+
   useEffect(() => {
     const fetchProducts = async () => {
       setIsLoading(true);
@@ -18,6 +18,7 @@ import {
 import { Tooltip, TooltipContent, TooltipProvider, TooltipTrigger } from '@radix-ui/react-tooltip';
 import axios from 'axios';
 import { useToast } from '@/hooks/use-toast';
+import { openEventStream } from '@/lib/eventStream';
 
 // Progress Tracker Component
 const ProgressTracker = ({ status, deliveryMethod }) => {
@@ -126,6 +127,27 @@ const TrackOrders = () => {
     fetchOrders();
   }, [navigate, toast]);
 
+  useEffect(() => {
+    return openEventStream('/orders/events', {
+      order: (event) => {
+        const update = JSON.parse(event.data);
+        setOrders((prev) =>
+          prev.map((o) =>
+            o.id === update.order_id
+              ? {
+                  ...o,
+                  status: update.status,
+                  pickup_time: update.pickup_time,
+                  tracking_link: update.tracking_link,
+                  updated_at: update.updated_at,
+                }
+              : o
+          )
+        );
+      },
+    });
+  }, []);
+
   const handleCancelOrder = async () => {
     setIsLoading(true);
     try {
@@ -4,6 +4,7 @@ import Sidebar from '@/components/Sidebar';
 import NotificationCard from '@/components/expert/NotificationCard';
 import { useNavigate } from 'react-router-dom';
 import { Button } from '@/components/ui/button';
+import { openEventStream } from '@/lib/eventStream';
 
 const ExpertNotifications = () => {
   const [notifications, setNotifications] = useState([]);
@@ -12,7 +13,21 @@ const ExpertNotifications = () => {
   const [success, setSuccess] = useState(null);
   const navigate = useNavigate();
 
+  // Subscribe before loading the list so no update can fall between the two. Events that
+  // arrive before the list loads are queued and applied on top of it; on 'reset' the
+  // stream missed events, so the list is reloaded.
   useEffect(() => {
+    let loaded = false;
+    let pending = [];
+
+    const applyUpdate = (list, update) => {
+      if (update.type === 'deleted') {
+        return list.filter((n) => n.id !== update.id);
+      }
+      const rest = list.filter((n) => n.id !== update.notification.id);
+      return [...rest, update.notification];
+    };
+
     const fetchNotifications = async () => {
       try {
         setLoading(true);
@@ -43,7 +58,9 @@ const ExpertNotifications = () => {
         }
         const data = JSON.parse(responseText);
         console.log('Parsed Data:', data);
-        setNotifications(data);
+        setNotifications(pending.reduce(applyUpdate, data));
+        pending = [];
+        loaded = true;
       } catch (err) {
         console.error('Fetch Error:', err);
         setError(`Error: ${err.message}`);
@@ -51,7 +68,38 @@ const ExpertNotifications = () => {
         setLoading(false);
       }
     };
-    fetchNotifications();
+
+    if (!localStorage.getItem('session_id')) {
+      setError('No session ID found. Please log in.');
+      navigate('/login');
+      return;
+    }
+    let opened = false;
+    return openEventStream(
+      '/notifications/events',
+      {
+        notification: (event) => {
+          const update = JSON.parse(event.data);
+          if (update.type === 'unread') return;
+          if (!loaded) {
+            pending.push(update);
+            return;
+          }
+          setNotifications((prev) => applyUpdate(prev, update));
+        },
+        reset: () => {
+          loaded = false;
+          fetchNotifications();
+        },
+      },
+      {
+        onOpen: () => {
+          if (opened) return;
+          opened = true;
+          fetchNotifications();
+        },
+      }
+    );
   }, [navigate]);
 
   useEffect(() => {